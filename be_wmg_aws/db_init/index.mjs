@@ -23,6 +23,55 @@ const dbUpdates = {
   2: [
     "ALTER TABLE lift_studies ADD COLUMN template_names VARCHAR(2000)",
   ],
+  3: [
+    // existing members keep a NULL assignment time, new ones get the insert time
+    "ALTER TABLE lift_studies_groups ADD COLUMN assigned_at TIMESTAMP NULL DEFAULT NULL",
+    "ALTER TABLE lift_studies_groups MODIFY COLUMN assigned_at TIMESTAMP NULL DEFAULT CURRENT_TIMESTAMP",
+  ],
+  4: [
+    // covering index for the lift studies conversions query
+    "CREATE INDEX idx_events_name_time ON events (event_name, event_time, user_phone)",
+  ],
+  5: [
+    // indexes for the lift studies signals query
+    "CREATE INDEX idx_signals_phone_keyword ON signals (consumer_phone_number, keyword_id, created_at)",
+    "CREATE INDEX idx_lift_studies_groups_study_phone ON lift_studies_groups (study_id, phone_number)",
+  ],
+  6: [
+    // hash based group assignment of lift studies
+    "ALTER TABLE lift_studies ADD COLUMN assignment_mode VARCHAR(16) NOT NULL DEFAULT 'random'",
+    "ALTER TABLE lift_studies ADD COLUMN assignment_salt VARCHAR(64)",
+  ],
+  7: [
+    // multi-arm lift studies
+    "ALTER TABLE lift_studies ADD COLUMN arm_names VARCHAR(2000)",
+  ],
+  8: [
+    // daily converters sketches of lift studies
+    `CREATE TABLE IF NOT EXISTS lift_studies_sketches (
+      study_id VARCHAR(255),
+      group_name VARCHAR(255),
+      event_name VARCHAR(255),
+      sketch_date DATE,
+      sketch MEDIUMBLOB,
+      PRIMARY KEY (study_id, event_name, sketch_date, group_name)
+    )`,
+  ],
+  9: [
+    // leases and stored results of lift study results requests
+    `CREATE TABLE IF NOT EXISTS lift_studies_results (
+      request_key CHAR(64) PRIMARY KEY,
+      status VARCHAR(16) NOT NULL,
+      lease_owner CHAR(32),
+      lease_expires_at TIMESTAMP NULL,
+      results MEDIUMTEXT,
+      updated_at TIMESTAMP NULL
+    )`,
+  ],
+  10: [
+    // index for the active lift study lookups
+    "CREATE INDEX idx_lift_studies_status_dates ON lift_studies (status, start_date, end_date)",
+  ],
 };
 
 export const lambdaHandler = async (event, context) => {
@@ -75,7 +124,8 @@ export const lambdaHandler = async (event, context) => {
           business_phone_number_id VARCHAR(20) NOT NULL,
           consumer_phone_number VARCHAR(20) NOT NULL,
           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-          FOREIGN KEY (keyword_id) REFERENCES keywords(id)
+          FOREIGN KEY (keyword_id) REFERENCES keywords(id),
+          INDEX idx_signals_phone_keyword (consumer_phone_number, keyword_id, created_at)
         )`
     );
 
@@ -101,7 +151,8 @@ export const lambdaHandler = async (event, context) => {
           event_time BIGINT,
           user_name varchar(250) NOT NULL,
           user_phone varchar(20) NOT NULL,
-          event_raw_data JSON
+          event_raw_data JSON,
+          INDEX idx_events_name_time (event_name, event_time, user_phone)
           )`
     );
 
@@ -134,7 +185,11 @@ export const lambdaHandler = async (event, context) => {
         test_group_size INT,
         messages_count INT,
         avg_message_cost DOUBLE,
-        status VARCHAR(255)
+        status VARCHAR(255),
+        assignment_mode VARCHAR(16) NOT NULL DEFAULT 'random',
+        assignment_salt VARCHAR(64),
+        arm_names VARCHAR(2000),
+        INDEX idx_lift_studies_status_dates (status, start_date, end_date)
       )`
     );
 
@@ -144,7 +199,35 @@ export const lambdaHandler = async (event, context) => {
       `CREATE TABLE IF NOT EXISTS lift_studies_groups (
         study_id VARCHAR(255),
         phone_number VARCHAR(20),
-        group_name VARCHAR(255)
+        group_name VARCHAR(255),
+        assigned_at TIMESTAMP NULL DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_lift_studies_groups_study_phone (study_id, phone_number)
+      )`
+    );
+
+    console.info('Creating lift studies sketches table schema');
+    await queryDatabase(
+      connection,
+      `CREATE TABLE IF NOT EXISTS lift_studies_sketches (
+        study_id VARCHAR(255),
+        group_name VARCHAR(255),
+        event_name VARCHAR(255),
+        sketch_date DATE,
+        sketch MEDIUMBLOB,
+        PRIMARY KEY (study_id, event_name, sketch_date, group_name)
+      )`
+    );
+
+    console.info('Creating lift studies results table schema');
+    await queryDatabase(
+      connection,
+      `CREATE TABLE IF NOT EXISTS lift_studies_results (
+        request_key CHAR(64) PRIMARY KEY,
+        status VARCHAR(16) NOT NULL,
+        lease_owner CHAR(32),
+        lease_expires_at TIMESTAMP NULL,
+        results MEDIUMTEXT,
+        updated_at TIMESTAMP NULL
       )`
     );
 
@@ -263,7 +346,8 @@ const getDatabasePassword = async () => {
 
 // Function to get the latest version of the database based on the dbUpdates object
 function getLatestDBVersion() {
-  return Object.keys(dbUpdates).sort().pop() || 0;
+  // versions are compared as numbers, as string order puts 10 before 9
+  return Math.max(0, ...Object.keys(dbUpdates).map(Number));
 };
 
 // Function to get the current version of the database based on the db_version table
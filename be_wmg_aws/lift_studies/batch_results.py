@@ -0,0 +1,277 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Recompute the results of every lift study from local snapshots.
+
+Usage:
+    python batch_results.py \
+        --events events_part_1.csv.gz events_part_2.csv.gz \
+        --studies lift_studies.csv \
+        --groups lift_studies_groups.csv \
+        --conversion-event Purchase \
+        --output results.json
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(__file__))
+
+from utils.data_utils import (
+    open_decompressed_stream,
+    read_conversions_csv,
+    stream_local_file,
+)
+from utils.lift_utils import (
+    build_multi_arm_results,
+    build_study_results,
+    count_conversions_by_group,
+    filter_conversions,
+)
+
+# state shared with the worker processes, set by the pool initializers
+_member_phones = None
+_conversions = None
+_study_groups = None
+
+
+def read_snapshot(path: str) -> pd.DataFrame:
+    """
+    Read a (possibly compressed) CSV table dump.
+
+    Args:
+        path (str): Path of the dump.
+
+    Returns:
+        table (pandas.DataFrame): DataFrame containing the table rows.
+    """
+    with open_decompressed_stream(stream_local_file(path)) as data:
+        return pd.read_csv(data, dtype=str, keep_default_na=False)
+
+
+def read_studies(path: str) -> pd.DataFrame:
+    """
+    Read a dump of the lift_studies table.
+
+    Args:
+        path (str): Path of the dump.
+
+    Returns:
+        studies (pandas.DataFrame): DataFrame containing the studies.
+    """
+    studies = read_snapshot(path)
+    for col in ("start_date", "end_date"):
+        studies[col] = pd.to_datetime(studies[col]).dt.date
+    for col in (
+        "sample_size",
+        "control_group_size",
+        "test_group_size",
+        "messages_count",
+    ):
+        studies[col] = studies[col].astype(int)
+    studies["avg_message_cost"] = studies["avg_message_cost"].astype(float)
+
+    return studies
+
+
+def read_study_groups(path: str) -> pd.DataFrame:
+    """
+    Read a dump of the lift_studies_groups table.
+
+    Args:
+        path (str): Path of the dump.
+
+    Returns:
+        study_groups (pandas.DataFrame): DataFrame containing the study groups.
+    """
+    study_groups = read_snapshot(path)[["study_id", "phone_number", "group_name"]]
+    # normalize phone numbers to include digits only
+    study_groups["phone_number"] = study_groups["phone_number"].str.replace(
+        r"[^0-9]", "", regex=True
+    )
+
+    return study_groups
+
+
+def _init_shard_worker(member_phones):
+    global _member_phones
+    _member_phones = member_phones
+
+
+def filter_shard(path: str, conversion_event_names, start_date, end_date):
+    """
+    Read an events shard and keep only the rows that may count for any study.
+
+    Args:
+        path (str): Path of the events shard.
+        conversion_event_names (list): Names of the conversion events.
+        start_date (datetime.date): Earliest start date among the studies.
+        end_date (datetime.date): Latest end date among the studies.
+
+    Returns:
+        conversions (pandas.DataFrame): DataFrame containing the relevant conversions.
+    """
+    conversions = read_conversions_csv(stream_local_file(path))
+    conversions = conversions[
+        conversions["event_time"].dt.date.ge(start_date)
+        & conversions["event_time"].dt.date.le(end_date)
+        & conversions["event_name"].isin(conversion_event_names)
+        & conversions["user_phone"].isin(_member_phones)
+    ]
+
+    return conversions[["event_name", "event_time", "user_phone"]]
+
+
+def _init_study_worker(conversions, study_groups):
+    global _conversions, _study_groups
+    _conversions = conversions
+    _study_groups = study_groups
+
+
+def compute_study(study: dict, conversion_event_name: str) -> dict:
+    """
+    Compute the results of a study for a given conversion event.
+
+    Args:
+        study (dict): Study information, as stored in the lift_studies table.
+        conversion_event_name (str): Name of the conversion event.
+
+    Returns:
+        record (dict): Results of the study, or the error that prevented them.
+    """
+    record = {"study_id": study["id"], "conversion_event": conversion_event_name}
+    try:
+        assert study["control_group_size"] > 0 and study["test_group_size"] > 0, (
+            "Group sizes must be greater than 0."
+        )
+        study_groups = _study_groups[_study_groups["study_id"] == study["id"]]
+        valid_conversions = filter_conversions(
+            _conversions,
+            study["start_date"],
+            study["end_date"],
+            conversion_event_name,
+            study_groups[["phone_number", "group_name"]],
+        )
+        assert not valid_conversions.empty, "No valid conversions found."
+        conversions_by_group = count_conversions_by_group(valid_conversions)
+        # dumps of studies created before multi-arm studies have no arm_names
+        if study.get("arm_names"):
+            record["results"] = build_multi_arm_results(
+                study,
+                conversions_by_group,
+                study_groups["group_name"].value_counts().to_dict(),
+            )
+        else:
+            record["results"] = build_study_results(study, conversions_by_group)
+    except Exception as e:
+        record["error"] = str(e)
+
+    return record
+
+
+def run(events, studies_path, groups_path, conversion_event_names, workers):
+    """
+    Recompute the results of every study in the snapshots.
+
+    Args:
+        events (list): Paths of the events shards.
+        studies_path (str): Path of the lift_studies dump.
+        groups_path (str): Path of the lift_studies_groups dump.
+        conversion_event_names (list): Names of the conversion events.
+        workers (int): Number of worker processes.
+
+    Returns:
+        records (list): Results for every (study, conversion event) pair.
+    """
+    studies = read_studies(studies_path)
+    study_groups = read_study_groups(groups_path)
+    if studies.empty:
+        return []
+
+    print(f"Filtering {len(events)} events shard(s)")
+    member_phones = frozenset(study_groups["phone_number"])
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_shard_worker,
+        initargs=(member_phones,),
+    ) as pool:
+        shards = list(
+            pool.map(
+                filter_shard,
+                events,
+                [conversion_event_names] * len(events),
+                [studies["start_date"].min()] * len(events),
+                [studies["end_date"].max()] * len(events),
+            )
+        )
+    conversions = pd.concat(shards, ignore_index=True)
+
+    print(f"Computing results for {len(studies)} studies")
+    tasks = [
+        (study, event_name)
+        for study in studies.to_dict(orient="records")
+        for event_name in conversion_event_names
+    ]
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_study_worker,
+        initargs=(conversions, study_groups),
+    ) as pool:
+        records = list(pool.map(compute_study, *zip(*tasks)))
+
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Recompute lift study results from local snapshots."
+    )
+    parser.add_argument(
+        "--events",
+        nargs="+",
+        required=True,
+        help="Events CSV shard(s), plain, gzip or zstd compressed.",
+    )
+    parser.add_argument(
+        "--studies", required=True, help="CSV dump of the lift_studies table."
+    )
+    parser.add_argument(
+        "--groups", required=True, help="CSV dump of the lift_studies_groups table."
+    )
+    parser.add_argument(
+        "--conversion-event",
+        nargs="+",
+        required=True,
+        dest="conversion_events",
+        help="Conversion event name(s) to compute results for.",
+    )
+    parser.add_argument("--output", required=True, help="Output JSON file.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args(argv)
+
+    records = run(
+        args.events, args.studies, args.groups, args.conversion_events, args.workers
+    )
+
+    with open(args.output, "w") as f:
+        json.dump(records, f, indent=2)
+
+    failed = sum("error" in record for record in records)
+    print(f"Wrote {len(records)} results to {args.output} ({failed} failed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmark the sharded parsing of the events file across numbers of workers.
+
+Usage:
+    python benchmark_sharded_parsing.py --events 5000000 --members 1000000 \
+        --workers 1 2 4 6 --compression gzip
+"""
+
+import argparse
+import datetime
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(__file__))
+
+from utils.data_utils import read_conversions_csv, stream_local_file
+from utils.lift_utils import StudyMembership, count_member_conversions
+from utils.shard_utils import count_member_conversions_sharded
+
+START_DATE = datetime.date(2024, 1, 1)
+END_DATE = datetime.date(2024, 1, 14)
+
+
+def write_events_file(path: str, num_events: int, num_phones: int, compression: str):
+    """
+    Write a synthetic events file, spanning a month around the study.
+
+    Args:
+        path (str): Path of the file.
+        num_events (int): Number of events.
+        num_phones (int): Number of distinct phone numbers.
+        compression (str): Either "none" or "gzip".
+    """
+    rng = np.random.default_rng(0)
+    phone_keys = 5511900000000 + rng.integers(0, num_phones, num_events)
+    events = pd.DataFrame(
+        {
+            "event_name": rng.choice(
+                ["Purchase", "ViewContent", "AddToCart"], num_events
+            ),
+            "event_time": pd.Timestamp("2023-12-24")
+            + pd.to_timedelta(rng.integers(0, 31 * 86400, num_events), unit="s"),
+            "user_name": "user",
+            "user_phone": "+" + pd.Series(phone_keys).astype(str),
+        }
+    )
+    opener = gzip.open if compression == "gzip" else open
+    with opener(path, "wb") as f:
+        f.write(events.to_csv(index=False).encode())
+
+
+def build_membership(num_members: int, num_phones: int) -> StudyMembership:
+    """
+    Build a synthetic two group membership among the phone numbers of the events.
+
+    Args:
+        num_members (int): Number of members.
+        num_phones (int): Number of distinct phone numbers of the events.
+
+    Returns:
+        membership (StudyMembership): Members of each group.
+    """
+    rng = np.random.default_rng(1)
+    keys = 5511900000000 + rng.choice(num_phones, num_members, replace=False)
+    return StudyMembership.from_batches(
+        [
+            {
+                "phone_number": keys.astype(str).astype(object),
+                "group_name": np.where(
+                    np.arange(num_members) % 2 == 0, "control", "test"
+                ).astype(object),
+            }
+        ]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sharded parsing of the events file."
+    )
+    parser.add_argument(
+        "--events", type=int, default=5_000_000, help="Number of synthetic events."
+    )
+    parser.add_argument(
+        "--members", type=int, default=1_000_000, help="Number of study members."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 6],
+        help="Numbers of worker processes to benchmark.",
+    )
+    parser.add_argument("--compression", choices=["none", "gzip"], default="none")
+    args = parser.parse_args(argv)
+
+    num_phones = max(args.members * 2, args.events // 5)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "events.csv")
+        print(f"Writing {args.events} events to {path} ({args.compression})")
+        write_events_file(path, args.events, num_phones, args.compression)
+        membership = build_membership(args.members, num_phones)
+        size_mb = os.path.getsize(path) / 1e6
+
+        started_at = time.perf_counter()
+        expected = count_member_conversions(
+            read_conversions_csv(stream_local_file(path)),
+            START_DATE,
+            END_DATE,
+            "Purchase",
+            membership,
+        )
+        baseline = time.perf_counter() - started_at
+        print(f"{size_mb:.0f} MB file, members with conversions: {expected}")
+        print(f"{'workers':>8} {'seconds':>8} {'MB/s':>8} {'speedup':>8}")
+        print(f"{'serial':>8} {baseline:8.2f} {size_mb / baseline:8.1f} {1:8.2f}")
+
+        for workers in args.workers:
+            started_at = time.perf_counter()
+            counts = count_member_conversions_sharded(
+                stream_local_file(path),
+                START_DATE,
+                END_DATE,
+                "Purchase",
+                membership,
+                workers,
+            )
+            elapsed = time.perf_counter() - started_at
+            assert counts == expected, f"{workers} workers counted {counts}."
+            print(
+                f"{workers:>8} {elapsed:8.2f} {size_mb / elapsed:8.1f} {baseline / elapsed:8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,50 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import asyncio
+import datetime
+import glob
+import hashlib
 import json
 import os
+import secrets
 import sys
+import time
 import uuid
 
-from utils.data_utils import LiftDatabaseHandler, LiftS3Handler
+import pandas as pd
+from utils.data_utils import (
+    LiftDatabaseHandler,
+    LiftS3Handler,
+    read_audience_csv,
+    read_conversions_csv,
+)
 from utils.lift_utils import (
-    calculate_cost_per_incremental_conversion,
+    PHONE_SAMPLE_MODULUS,
+    PHONE_SAMPLE_MULTIPLIER,
+    StudyMembership,
+    accumulate_value_sums,
+    assign_groups_by_hash,
+    build_cuped_results,
+    build_daily_sketches,
+    build_multi_arm_results,
+    build_study_results,
+    build_value_study_results,
+    count_conversions_by_group,
+    count_cuped_flags_by_group,
+    count_member_conversions,
     filter_conversions,
-    get_study_stats,
+    filter_conversions_with_pre_period,
+    filter_exposed_conversions,
+    get_conversions_in_window,
+    get_phone_sample_threshold,
+    merge_sketches_by_group,
+    normalize_phone_numbers,
+    split_audience,
+    split_audience_by_hash,
+    split_audience_into_arms,
 )
+from utils.shard_utils import count_member_conversions_sharded
 
 sys.path.append(os.path.dirname(__file__))
 
@@ -23,9 +56,80 @@ db_user = os.environ.get("DB_USER", None)
 db_host = os.environ.get("DB_HOST", None)
 db_name = os.environ.get("DB_NAME", None)
 bucket_name = os.environ.get("BUCKET_NAME", None)
+# events file may be plain, gzip or zstd compressed CSV
+events_file_key = os.environ.get("EVENTS_FILE_KEY", "events.csv")
+# serialized study memberships are cached here between invocations
+membership_cache_dir = os.environ.get("MEMBERSHIP_CACHE_DIR", "/tmp")
+# conversion events the sketches job builds converters sketches for
+sketch_conversion_events = os.environ.get("SKETCH_CONVERSION_EVENTS", "")
+# throughput used to estimate if the conversions can be read within a time budget
+events_table_rows_per_second = float(
+    os.environ.get("EVENTS_TABLE_ROWS_PER_SECOND", 1e6)
+)
+# worker processes parsing the events file, for study_window results
+events_parse_workers = int(os.environ.get("EVENTS_PARSE_WORKERS", 1))
+# the parsed events file is reused by the requests of a warm container until it changes
+events_file_cache_enabled = os.environ.get("EVENTS_FILE_CACHE", "true") == "true"
+# the database connection is kept open between the requests of a warm container
+db_keep_alive = os.environ.get("DB_KEEP_ALIVE", "true") == "true"
+# warm up while the container starts, for provisioned concurrency
+warm_up_on_init = os.environ.get("WARM_UP_ON_INIT", "false") == "true"
+# smallest phone sample used when the time budget is short
+MIN_SAMPLE_FRACTION = 0.01
+# study rows are reused by the requests of a warm container for a few seconds
+study_metadata_ttl_seconds = float(os.environ.get("STUDY_METADATA_TTL_SECONDS", 5))
+# concurrent identical results requests wait for a single computation
+results_lease_seconds = int(os.environ.get("RESULTS_LEASE_SECONDS", 60))
+results_ttl_seconds = int(os.environ.get("RESULTS_TTL_SECONDS", 60))
+results_wait_seconds = float(os.environ.get("RESULTS_WAIT_SECONDS", 25))
+RESULTS_POLL_SECONDS = 1
+
+# fields returned when listing studies, the assignment salt is kept private
+STUDY_LIST_FIELDS = (
+    "id",
+    "name",
+    "start_date",
+    "end_date",
+    "sample_size",
+    "template_names",
+    "control_group_size",
+    "test_group_size",
+    "messages_count",
+    "avg_message_cost",
+    "status",
+    "assignment_mode",
+    "arm_names",
+)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# events_file: conversions are read from the events file in S3
+# events_table: conversions are queried from the events table
+# signals: conversions are the keyword signals with the conversion event name
+CONVERSION_SOURCES = ("events_file", "events_table", "signals")
+default_conversion_source = os.environ.get("CONVERSION_SOURCE", "events_file")
+
+# study_window: any conversion within the study's timeframe counts
+# exposure: only conversions after the member was assigned to a group count
+ATTRIBUTION_MODES = ("study_window", "exposure")
+
+# conversions: share of members with at least one conversion
+# value: conversion value (custom_data.value) per member
+METRICS = ("conversions", "value")
+
+# random: the router draws the group of each new member at random
+# hash: the group is a keyed hash of the phone number with a per-study salt
+ASSIGNMENT_MODES = ("random", "hash")
 
 # initialize database handler
-db = LiftDatabaseHandler()
+db = LiftDatabaseHandler(keep_alive=db_keep_alive)
+
+# study ID -> (expiry time, StudyMetadata), see get_study_metadata
+_study_metadata_cache = {}
+# S3 handler shared by the requests of a warm container, see get_s3_handler
+_s3_handler = None
+# (ETag, parsed events file), see get_events_file_conversions
+_events_file_cache = None
 
 
 def lambda_handler(event, context):
@@ -39,6 +143,10 @@ def lambda_handler(event, context):
     Returns:
         response (dict): Response to be returned by the lambda function.
     """
+    # scheduled pings keep the container warm, see warm_up
+    if event.get("warmup"):
+        return warm_up()
+
     # get request parameters
     http_method = event.get("httpMethod", None)
     request_body = event.get("body", None)
@@ -48,14 +156,38 @@ def lambda_handler(event, context):
     if event["pathParameters"]:
         study_id = event["pathParameters"].get("id", None)
 
-    conversion_event_name = None
-    if event["queryStringParameters"]:
-        conversion_event_name = event["queryStringParameters"].get(
-            "conversion_event", None
-        )
+    query_params = event["queryStringParameters"] or {}
+    conversion_event_name = query_params.get("conversion_event", None)
+    attribution = query_params.get("attribution", "study_window")
+    attribution_window_hours = query_params.get("attribution_window_hours", None)
+    conversion_source = query_params.get("conversion_source", default_conversion_source)
+    metric = query_params.get("metric", "conversions")
+    cuped_pre_period_days = query_params.get("cuped_pre_period_days", None)
+    approximate = query_params.get("approximate", "false").lower() == "true"
+    time_budget_seconds = query_params.get("time_budget_seconds", None)
 
     # handle requests
-    if http_method == "POST":
+    if http_method == "POST" and study_id:
+        print("Assigning audience to Lift Study groups")
+        try:
+            assert (
+                "audience_file_key" in request_data or "phone_numbers" in request_data
+            ), "Either audience_file_key or phone_numbers must be specified."
+
+            assigned = assign_lift_study_audience(study_id, request_data)
+
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json"},
+                "body": json.dumps(assigned),
+            }
+        except Exception as e:
+            return abort(
+                400,
+                message=f"Error while assigning audience to lift study {study_id}: {e}",
+            )
+
+    elif http_method == "POST":
         print("Creating Lift Study")
         try:
             required_fields = [
@@ -74,6 +206,27 @@ def lambda_handler(event, context):
             ), (
                 "Template name must be composed by lowercase letters, numbers, and underscores."
             )
+            assert request_data.get("assignment_mode", "random") in ASSIGNMENT_MODES, (
+                f"assignment_mode must be one of {ASSIGNMENT_MODES}."
+            )
+            assert "assignment_salt" not in request_data, (
+                "assignment_salt is generated for hash assignment mode studies."
+            )
+            if request_data.get("arm_names"):
+                arm_names = request_data["arm_names"].split(",")
+                assert all(validate_template_name(an) for an in arm_names), (
+                    "Arm name must be composed by lowercase letters, numbers, and underscores."
+                )
+                assert "control" not in arm_names and "test" not in arm_names, (
+                    "Arm names must not include control or test."
+                )
+                # the router only sends the template of an arm to its members
+                assert len(set(arm_names)) == len(arm_names) and set(arm_names) == set(
+                    request_data["template_names"].split(",")
+                ), "Arm names must be the template names, one arm per template."
+                assert request_data.get("assignment_mode", "random") == "random", (
+                    "Multi-arm studies only support the random assignment mode."
+                )
 
             study_id = create_lift_study(request_data)
 
@@ -93,11 +246,63 @@ def lambda_handler(event, context):
                     "Conversion event name must be specified in the format conversion_event=<your event>"
                 )
 
-                results = get_lift_study_results(study_id, conversion_event_name)
+                assert attribution in ATTRIBUTION_MODES, (
+                    f"Attribution must be one of {', '.join(ATTRIBUTION_MODES)}."
+                )
+
+                assert conversion_source in CONVERSION_SOURCES, (
+                    f"Conversion source must be one of {', '.join(CONVERSION_SOURCES)}."
+                )
+
+                assert metric in METRICS, f"Metric must be one of {', '.join(METRICS)}."
+
+                results_params = {
+                    "metric": metric,
+                    "conversion_source": conversion_source,
+                    "attribution": attribution,
+                    "attribution_window_hours": (
+                        float(attribution_window_hours)
+                        if attribution_window_hours
+                        else None
+                    ),
+                    "cuped_pre_period_days": (
+                        int(cuped_pre_period_days) if cuped_pre_period_days else None
+                    ),
+                    "approximate": approximate,
+                    "time_budget_seconds": (
+                        float(time_budget_seconds) if time_budget_seconds else None
+                    ),
+                }
+
+                # answer before computing anything if the client has the results
+                etag = get_results_etag(
+                    study_id, conversion_event_name, **results_params
+                )
+                if etag and etag_matches(get_header(event, "If-None-Match"), etag):
+                    print("Results not modified")
+                    return {"statusCode": 304, "headers": {"ETag": etag}, "body": ""}
+
+                results = get_coalesced_lift_study_results(
+                    study_id, conversion_event_name, version=etag, **results_params
+                )
+                if results is None:
+                    return {
+                        "statusCode": 202,
+                        "headers": {
+                            "Content-Type": "application/text",
+                            "Retry-After": str(RESULTS_POLL_SECONDS * 5),
+                        },
+                        "body": "Results are being computed by another request, retry later.",
+                    }
+
+                headers = {"Content-Type": "application/json"}
+                # partial results are not cached, the next request may complete them
+                if etag and not results.get("partial"):
+                    headers["ETag"] = etag
 
                 return {
                     "statusCode": 200,
-                    "headers": {"Content-Type": "application/json"},
+                    "headers": headers,
                     "body": json.dumps(results),
                 }
             except Exception as e:
@@ -108,28 +313,53 @@ def lambda_handler(event, context):
         else:
             print("Getting all Lift Studies")
             try:
+                fields = query_params.get("fields", None)
+                fields = fields.split(",") if fields else list(STUDY_LIST_FIELDS)
+                assert all(field in STUDY_LIST_FIELDS for field in fields), (
+                    f"Fields must be among {', '.join(STUDY_LIST_FIELDS)}."
+                )
+                limit = int(query_params.get("limit", DEFAULT_PAGE_SIZE))
+                assert 0 < limit <= MAX_PAGE_SIZE, (
+                    f"Limit must be between 1 and {MAX_PAGE_SIZE}."
+                )
+                from_date = query_params.get("from_date", None)
+                to_date = query_params.get("to_date", None)
+
                 # connect to the database
                 db.connect(db_secret_arn, db_user, db_host, db_name)
 
-                # read all studies from the database
-                studies = db.read_table("lift_studies")
-                # format dates
-                studies["start_date"] = studies["start_date"].apply(
-                    lambda x: x.strftime("%Y-%m-%d")
-                )
-                studies["end_date"] = studies["end_date"].apply(
-                    lambda x: x.strftime("%Y-%m-%d")
+                # read a page of studies, filtered and with formatted dates
+                studies = db.list_studies(
+                    fields,
+                    status=query_params.get("status", None),
+                    from_date=(
+                        datetime.date.fromisoformat(from_date) if from_date else None
+                    ),
+                    to_date=datetime.date.fromisoformat(to_date) if to_date else None,
+                    after_id=query_params.get("cursor", None),
+                    limit=limit,
                 )
-                # convert to json
-                studies_json = studies.to_json(orient="records")
 
                 # close the database connection
                 db.close()
 
+                # the last ID is the cursor of the next page, if the page is full
+                headers = {"Content-Type": "application/json"}
+                if len(studies) == limit:
+                    headers["X-Next-Cursor"] = studies[-1]["id"]
+                if "id" not in fields:
+                    for study in studies:
+                        del study["id"]
+
+                body = json.dumps(studies)
+                headers["ETag"] = f'"{hashlib.sha256(body.encode()).hexdigest()[:32]}"'
+                if etag_matches(get_header(event, "If-None-Match"), headers["ETag"]):
+                    return {"statusCode": 304, "headers": headers, "body": ""}
+
                 return {
                     "statusCode": 200,
-                    "headers": {"Content-Type": "application/json"},
-                    "body": studies_json,
+                    "headers": headers,
+                    "body": body,
                 }
             except Exception as e:
                 return abort(400, message=f"Error while getting all lift studies: {e}")
@@ -137,8 +367,20 @@ def lambda_handler(event, context):
     elif http_method == "PATCH":
         print("Updating Lift Study Status")
         try:
-            updated_fields = []
-            updated_fields = update_lift_study_data(study_id, request_data)
+            if study_id:
+                updated_fields = update_lift_study_data([(study_id, request_data)])
+                updated_fields = updated_fields[study_id]
+            else:
+                # bulk update, a list of studies with their ID and data to update
+                assert isinstance(request_data, list), (
+                    "Request body must be a list of studies to update."
+                )
+                updated_fields = update_lift_study_data(
+                    [
+                        (study_data.get("id", None), study_data)
+                        for study_data in request_data
+                    ]
+                )
 
             return {
                 "statusCode": 200,
@@ -161,16 +403,9 @@ def create_lift_study(study_data):
     Returns:
         study_id (str): ID of the created study.
     """
-    # connect to the database
-    db.connect(db_secret_arn, db_user, db_host, db_name)
-
-    # check if there is another active study
-    assert db.get_active_study_id() is None, "There is an active study running."
-
     # generate a random study id
     study_id = uuid.uuid4().hex
 
-    # insert the study info into the database
     study_info = {
         "id": study_id,
         **study_data,
@@ -180,71 +415,589 @@ def create_lift_study(study_data):
         "avg_message_cost": 0,
         "status": "active",
     }
-    db.upload_new_study(study_info)
-    db.close()
+    if study_info.get("assignment_mode") == "hash":
+        study_info["assignment_salt"] = secrets.token_hex(16)
+
+    # connect to the database
+    db.connect(db_secret_arn, db_user, db_host, db_name)
+    db.begin_transaction()
+    try:
+        # check if the templates are used by another study during the same dates,
+        # locking the studies so concurrent creations and activations wait for this
+        # transaction
+        check_templates_available(
+            study_id,
+            study_data["template_names"].split(","),
+            datetime.date.fromisoformat(study_data["start_date"]),
+            datetime.date.fromisoformat(study_data["end_date"]),
+            db.get_scheduled_studies(for_update=True),
+        )
+
+        # insert the study info into the database
+        db.upload_new_study(study_info, commit=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
     return study_id
 
 
-def get_lift_study_results(study_id: str, conversion_event_name: str):
+def assign_lift_study_audience(study_id: str, request_data: dict):
+    """
+    Assign an audience list to the groups of a lift study in bulk.
+
+    Phones already assigned to the study are skipped, and the rest are split
+    between control and test (or the arms of a multi-arm study) up to the study's
+    sample size, at random or by the study's hash assignment. All members are inserted and the group sizes updated
+    in a single transaction.
+
+    Args:
+        study_id (str): ID of the study.
+        request_data (dict): Either the S3 key of a (possibly compressed) CSV audience
+            file in audience_file_key, or a list of phone_numbers. An optional seed
+            makes the split reproducible.
+
+    Returns:
+        assigned (dict): Number of phones assigned to each group, already in the
+            study, and left out because both groups are full.
+    """
+    if "audience_file_key" in request_data:
+        print(f"Reading audience from {request_data['audience_file_key']} file in S3")
+        s3 = get_s3_handler()
+        audience = read_audience_csv(
+            s3.stream_file(bucket_name, request_data["audience_file_key"])
+        )
+    else:
+        audience = pd.Series(request_data["phone_numbers"], dtype=object)
+
+    phone_numbers = normalize_phone_numbers(audience)
+    print(f"Audience has {len(phone_numbers)} unique phone numbers")
+
+    db.connect(db_secret_arn, db_user, db_host, db_name)
+    db.begin_transaction()
+    try:
+        # lock the study row so the router cannot change the groups meanwhile
+        sample_size, control_group_size, test_group_size = db.get_study_group_sizes(
+            study_id, for_update=True
+        )
+        assignment = db.get_study_metadata(study_id)
+
+        assigned_phones = db.read_table(
+            "lift_studies_groups",
+            columns=["phone_number"],
+            filters="study_id = %s",
+            params=(study_id,),
+            as_arrays=True,
+        )["phone_number"]
+        is_new = (
+            ~pd.Series(phone_numbers, dtype=object)
+            .isin(normalize_phone_numbers(assigned_phones))
+            .to_numpy()
+        )
+
+        if assignment.arm_names:
+            group_sizes = db.get_study_group_counts(study_id)
+            new_phones, group_names = split_audience_into_arms(
+                phone_numbers[is_new],
+                {
+                    group_name: sample_size - group_sizes.get(group_name, 0)
+                    for group_name in ["control"] + assignment.arm_names.split(",")
+                },
+                seed=request_data.get("seed"),
+            )
+        elif assignment.assignment_mode == "hash":
+            new_phones, group_names = split_audience_by_hash(
+                phone_numbers[is_new],
+                study_id,
+                assignment.assignment_salt,
+                sample_size - control_group_size,
+                sample_size - test_group_size,
+            )
+        else:
+            new_phones, group_names = split_audience(
+                phone_numbers[is_new],
+                sample_size - control_group_size,
+                sample_size - test_group_size,
+                seed=request_data.get("seed"),
+            )
+        # the members of every arm count towards the test group size
+        control_count = int((group_names == "control").sum())
+        test_count = len(group_names) - control_count
+
+        print(f"Inserting {len(new_phones)} study group members")
+        db.insert_study_groups(study_id, new_phones, group_names)
+        db.increment_study_group_sizes(study_id, control_count, test_count)
+        db.commit()
+        invalidate_study_metadata(study_id)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    return {
+        "control": control_count,
+        "test": test_count,
+        "already_assigned": int((~is_new).sum()),
+        "left_out": int(is_new.sum()) - len(new_phones),
+    }
+
+
+def get_study_metadata(study_id: str):
+    """
+    Get the row of a study, reused for study_metadata_ttl_seconds by the requests
+    of a warm container. Writes of this handler invalidate it.
+
+    The database connection must be open.
+
+    Args:
+        study_id (str): ID of the study.
+
+    Returns:
+        study (StudyMetadata): Fields of the study.
+    """
+    now = time.monotonic()
+    cached = _study_metadata_cache.get(study_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    study = db.get_study_metadata(study_id)
+    assert study is not None, f"Study {study_id} does not exist."
+
+    # drop expired rows, so the cache only holds recently requested studies
+    for expired_id in [
+        k for k, (expires_at, _) in _study_metadata_cache.items() if expires_at <= now
+    ]:
+        del _study_metadata_cache[expired_id]
+    _study_metadata_cache[study_id] = (now + study_metadata_ttl_seconds, study)
+
+    return study
+
+
+def invalidate_study_metadata(study_id: str):
+    """
+    Drop the cached row of a study, after it is written.
+
+    Args:
+        study_id (str): ID of the study.
+    """
+    _study_metadata_cache.pop(study_id, None)
+
+
+def get_hash_assignment_salt(study):
+    """
+    Get the salt the groups of a study are computed with, in the hash assignment
+    mode. The groups of other studies are the ones stored by the router.
+
+    Args:
+        study (StudyMetadata): Fields of the study.
+
+    Returns:
+        assignment_salt (str): Assignment salt, or None if the study is not in the
+            hash assignment mode.
+    """
+    if study.assignment_mode != "hash":
+        return None
+
+    return study.assignment_salt
+
+
+def check_templates_available(
+    study_id: str,
+    template_names: list,
+    start_date,
+    end_date,
+    scheduled_studies: dict,
+):
+    """
+    Check that none of the templates of a study is used by another study that is
+    not paused and whose dates overlap, so each template message belongs to at
+    most one active study on any day.
+
+    Args:
+        study_id (str): ID of the study.
+        template_names (list): Template names of the study.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        scheduled_studies (dict): Start date, end date and list of template names of
+            the studies that are not paused, see get_scheduled_studies.
+    """
+    used = sorted(
+        f"{template_name} ({other_id})"
+        for other_id, (other_start, other_end, other_templates) in (
+            scheduled_studies.items()
+        )
+        if other_id != study_id and other_start <= end_date and start_date <= other_end
+        for template_name in set(template_names) & set(other_templates)
+    )
+    assert not used, (
+        f"Templates already used by an active study with overlapping dates: "
+        f"{', '.join(used)}."
+    )
+
+
+def get_results_etag(study_id: str, conversion_event_name: str, **params):
+    """
+    Get the entity tag of the results of a lift study, without computing them.
+
+    The tag changes whenever the study row (dates, group sizes, messages), the
+    request parameters or the version of the conversions source change.
+
+    Args:
+        study_id (str): ID of the study to get results for.
+        conversion_event_name (str): Name of the conversion event (or keyword signal) to get results for.
+        **params: Other parameters of get_lift_study_results.
+
+    Returns:
+        etag (str): Quoted entity tag, or None if the results can not be tagged.
+    """
+    # sketches are rebuilt in place and have no version
+    if params.get("approximate"):
+        return None
+
+    db.connect(db_secret_arn, db_user, db_host, db_name)
+    try:
+        study = get_study_metadata(study_id).to_dict()
+
+        conversion_source = params.get("conversion_source")
+        if conversion_source == "signals":
+            source_version = db.get_signals_version()
+        elif conversion_source == "events_table":
+            source_version = db.get_conversion_events_version(
+                conversion_event_name,
+                study["start_date"]
+                - datetime.timedelta(days=params.get("cuped_pre_period_days") or 0),
+                study["end_date"],
+            )
+        else:
+            source_version = get_s3_handler().get_file_etag(
+                bucket_name, events_file_key
+            )
+    finally:
+        db.close()
+
+    tagged = json.dumps(
+        {
+            "study": study,
+            "conversion_event": conversion_event_name,
+            "params": params,
+            "source_version": source_version,
+        },
+        sort_keys=True,
+        default=str,
+    )
+
+    return f'"{hashlib.sha256(tagged.encode()).hexdigest()[:32]}"'
+
+
+def get_coalesced_lift_study_results(
+    study_id: str, conversion_event_name: str, version: str = None, **params
+):
+    """
+    Get results for a given lift study, computing them once for concurrent
+    identical requests.
+
+    The first request takes a lease row in the lift_studies_results table and
+    computes the results, while identical requests poll the row for them. Stored
+    results are reused for results_ttl_seconds, and only by requests with the
+    same version of the study and conversions.
+
+    Args:
+        study_id (str): ID of the study to get results for.
+        conversion_event_name (str): Name of the conversion event (or keyword signal) to get results for.
+        version (str): Version of the inputs of the results, see get_results_etag.
+            Defaults to None (results stored for any version are reused).
+        **params: Other parameters of get_lift_study_results.
+
+    Returns:
+        results (dict): Results for the study, or None if another request is still
+            computing them after waiting results_wait_seconds.
+    """
+    request_key = hashlib.sha256(
+        json.dumps(
+            {
+                "study_id": study_id,
+                "conversion_event": conversion_event_name,
+                "version": version,
+                **params,
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+    owner = uuid.uuid4().hex
+    wait_until = time.monotonic() + results_wait_seconds
+
+    db.connect(db_secret_arn, db_user, db_host, db_name)
+    try:
+        while True:
+            state, stored_results = db.acquire_results_lease(
+                request_key, owner, results_lease_seconds, results_ttl_seconds
+            )
+            if state == "done":
+                print("Using results stored by an identical request")
+                return json.loads(stored_results)
+            if state == "acquired":
+                break
+            if time.monotonic() + RESULTS_POLL_SECONDS > wait_until:
+                return None
+            print("Waiting for the results of an identical request")
+            time.sleep(RESULTS_POLL_SECONDS)
+    finally:
+        db.close()
+
+    try:
+        if events_parse_workers > 1:
+            # the parsing workers are forked, which is only safe from the main thread
+            results = get_lift_study_results(study_id, conversion_event_name, **params)
+        else:
+            results = asyncio.run(
+                get_lift_study_results_async(study_id, conversion_event_name, **params)
+            )
+    except Exception:
+        db.connect(db_secret_arn, db_user, db_host, db_name)
+        db.release_results_lease(request_key, owner)
+        db.close()
+        raise
+
+    db.connect(db_secret_arn, db_user, db_host, db_name)
+    db.store_results(request_key, owner, json.dumps(results))
+    db.close()
+
+    return results
+
+
+def get_lift_study_results(
+    study_id: str,
+    conversion_event_name: str,
+    metric: str = "conversions",
+    conversion_source: str = "events_file",
+    attribution: str = "study_window",
+    attribution_window_hours: float = None,
+    cuped_pre_period_days: int = None,
+    approximate: bool = False,
+    time_budget_seconds: float = None,
+):
     """
     Get results for a given lift study.
 
     Args:
         study_id (str): ID of the study to get results for.
-        conversion_event_name (str): Name of the conversion event to get results for.
+        conversion_event_name (str): Name of the conversion event (or keyword signal) to get results for.
+        metric (str): Metric to measure the lift on, one of METRICS. Defaults to "conversions".
+        conversion_source (str): Where to read conversions from, one of CONVERSION_SOURCES. Defaults to "events_file".
+        attribution (str): Attribution mode, one of ATTRIBUTION_MODES. Defaults to "study_window".
+        attribution_window_hours (float): In exposure mode, maximum hours between the
+            assignment and the conversion. Defaults to None (until the end of the study).
+        cuped_pre_period_days (int): Number of days before the study used as the CUPED
+            covariate window. Defaults to None (no CUPED adjustment).
+        approximate (bool): Whether or not to estimate the converters of each group from
+            the daily sketches built by the sketches job. Defaults to False.
+        time_budget_seconds (float): With study_window attribution on the events
+            table, time the results should take. If the conversions can not be read
+            within it, results are estimated on a consistent sample of the phone
+            numbers and flagged as partial. Defaults to None (no budget).
 
     Returns:
         results (dict): Results for the study.
     """
+    started_at = time.monotonic()
+
     print("Connecting to database")
     db.connect(db_secret_arn, db_user, db_host, db_name)
 
-    print("Checking if study exists")
-    assert db.exists_study_with_id(study_id), f"Study {study_id} does not exist."
-
-    # create s3 handler object
-    s3 = LiftS3Handler()
-
     print("Fetching study data")
     try:
-        study_df = db.read_table("lift_studies", filters=f"id = '{study_id}'")
-
-        study_name = study_df["name"].values[0]
-        start_date = study_df["start_date"].values[0]
-        end_date = study_df["end_date"].values[0]
-        sample_size = study_df["sample_size"].values[0]
-        control_group_size = study_df["control_group_size"].values[0]
-        test_group_size = study_df["test_group_size"].values[0]
-        num_msgs = study_df["messages_count"].values[0]
-        avg_msg_cost = study_df["avg_message_cost"].values[0]
-
-        assert control_group_size > 0 and test_group_size > 0, (
-            "Group sizes must be greater than 0."
-        )
+        study_metadata = get_study_metadata(study_id)
+
+        start_date = study_metadata.start_date
+        end_date = study_metadata.end_date
+        control_group_size = study_metadata.control_group_size
+        test_group_size = study_metadata.test_group_size
+        num_msgs = study_metadata.messages_count
+        assignment_salt = get_hash_assignment_salt(study_metadata)
+        arm_names = study_metadata.arm_names
+
+        assert (
+            study_metadata.control_group_size > 0 and study_metadata.test_group_size > 0
+        ), "Group sizes must be greater than 0."
     except Exception as e:
         raise Exception(f"Error while fetching data for study {study_id}.", e)
 
-    try:
-        print("Reading conversions from events.csv file in S3")
-        conversions = s3.get_conversions_from_s3(bucket_name, "events.csv")
+    study = {
+        "name": study_metadata.name,
+        "start_date": start_date,
+        "end_date": end_date,
+        "sample_size": study_metadata.sample_size,
+        "control_group_size": control_group_size,
+        "test_group_size": test_group_size,
+        "messages_count": num_msgs,
+        "avg_message_cost": study_metadata.avg_message_cost,
+    }
 
-        print("Reading study groups table")
-        study_groups = db.read_table(
-            "lift_studies_groups", filters=f"study_id = '{study_id}'"
+    if cuped_pre_period_days:
+        assert metric == "conversions" and conversion_source != "signals", (
+            "CUPED is only available for the conversions metric on events."
         )
-        study_groups = study_groups[["phone_number", "group_name"]]
-        # normalize phone numbers to include digits only
-        study_groups.loc[:, "phone_number"] = study_groups["phone_number"].str.replace(
-            r"[^0-9]", "", regex=True
+        assert attribution == "study_window", (
+            "CUPED is only available with study_window attribution."
         )
 
-        print("Filtering valid conversions")
-        valid_conversions = filter_conversions(
-            conversions, start_date, end_date, conversion_event_name, study_groups
+    if arm_names:
+        assert metric == "conversions" and not cuped_pre_period_days, (
+            "Multi-arm studies only support the conversions metric without CUPED."
+        )
+
+    if approximate:
+        assert (
+            metric == "conversions" and not cuped_pre_period_days and not arm_names
+        ), (
+            "Approximate results are only available for the conversions metric of two group studies without CUPED."
+        )
+        assert attribution == "study_window", (
+            "Approximate results are only available with study_window attribution."
         )
 
-        assert not valid_conversions.empty, "No valid conversions found."
+        try:
+            print("Merging converters sketches")
+            conversions_by_group, relative_error = merge_sketches_by_group(
+                db.read_study_sketches(
+                    study_id, conversion_event_name, start_date, end_date
+                )
+            )
+
+            assert sum(conversions_by_group.values()) > 0, "No valid conversions found."
+        except Exception as e:
+            raise Exception(
+                f"Error while reading converters sketches ({conversion_event_name}) for study {study_id}.",
+                e,
+            )
+
+        results = build_study_results(study, conversions_by_group, relative_error)
+        results["approximate"] = "true"
+        results["relative_standard_error"] = str(round(relative_error, 4))
+
+        db.close()
+
+        return results
+
+    if metric == "value":
+        try:
+            assert conversion_source == "events_table", (
+                "Value lift is only available with conversion_source=events_table."
+            )
+            assert attribution == "study_window", (
+                "Value lift is only available with study_window attribution."
+            )
+            value_sums_by_group = get_value_sums_by_group(
+                study_id, conversion_event_name, start_date, end_date
+            )
+
+            assert value_sums_by_group, "No valid conversions found."
+        except Exception as e:
+            raise Exception(
+                f"Error while fetching conversion values ({conversion_event_name}) for study {study_id}.",
+                e,
+            )
+
+        try:
+            print("Calculating value metrics")
+            results = build_value_study_results(study, value_sums_by_group)
+        except Exception as e:
+            raise Exception(
+                f"Error while calculating value metrics for study {study_id}.", e
+            )
+
+        db.close()
+
+        return results
+
+    sample_fraction = 1.0
+    try:
+        if conversion_source == "signals":
+            print("Counting signalling consumers per group")
+            conversions_by_group = db.count_signal_conversions_by_group(
+                study_id,
+                conversion_event_name,
+                start_date,
+                end_date,
+                exposure_only=attribution == "exposure",
+                attribution_window_hours=attribution_window_hours,
+            )
+        elif cuped_pre_period_days:
+            conversion_flags = get_valid_conversions(
+                study_id,
+                conversion_event_name,
+                start_date,
+                end_date,
+                conversion_source,
+                attribution,
+                attribution_window_hours,
+                pre_period_days=cuped_pre_period_days,
+                assignment_salt=assignment_salt,
+            )
+            conversions_by_group = count_conversions_by_group(
+                conversion_flags[conversion_flags["in_study"]]
+            )
+        elif attribution == "study_window":
+            conversions = None
+            # the events file is read whole, so a sample of it would take as long
+            if time_budget_seconds and conversion_source == "events_table":
+                sample_fraction = get_sample_fraction(
+                    conversion_event_name,
+                    start_date,
+                    end_date,
+                    time_budget_seconds - (time.monotonic() - started_at),
+                )
+            membership = get_study_membership(
+                study_id, control_group_size, test_group_size, assignment_salt
+            )
+            if (
+                events_parse_workers > 1
+                and conversion_source == "events_file"
+                and sample_fraction == 1
+            ):
+                conversions_by_group = count_events_file_members(
+                    start_date, end_date, conversion_event_name, membership
+                )
+            else:
+                conversions = read_conversions(
+                    conversion_event_name,
+                    start_date,
+                    end_date,
+                    conversion_source,
+                    sample_fraction=sample_fraction if sample_fraction < 1 else None,
+                )
+            if sample_fraction < 1:
+                # results are computed on the members in the sample
+                membership = membership.sample(sample_fraction)
+                sampled_sizes = membership.count()
+                study["messages_count"] = round(
+                    num_msgs * sampled_sizes.get("test", 0) / test_group_size
+                )
+                study["control_group_size"] = sampled_sizes.get("control", 0)
+                study["test_group_size"] = sampled_sizes.get("test", 0)
+            if conversions is not None:
+                print("Counting converted members per group")
+                conversions_by_group = count_member_conversions(
+                    conversions, start_date, end_date, conversion_event_name, membership
+                )
+        else:
+            valid_conversions = get_valid_conversions(
+                study_id,
+                conversion_event_name,
+                start_date,
+                end_date,
+                conversion_source,
+                attribution,
+                attribution_window_hours,
+                assignment_salt=assignment_salt,
+            )
+            conversions_by_group = count_conversions_by_group(valid_conversions)
+
+        assert sum(conversions_by_group.values()) > 0, "No valid conversions found."
     except Exception as e:
         raise Exception(
             f"Error while fetching valid conversion events ({conversion_event_name}) for study {study_id}.",
@@ -253,101 +1006,868 @@ def get_lift_study_results(study_id: str, conversion_event_name: str):
 
     try:
         print("Calculating metrics")
-        (control_results, test_results, lift_perc, p_value) = get_study_stats(
-            valid_conversions, control_group_size, test_group_size
-        )
+        if arm_names:
+            results = build_multi_arm_results(
+                study,
+                conversions_by_group,
+                (
+                    sampled_sizes
+                    if sample_fraction < 1
+                    else db.get_study_group_counts(study_id)
+                ),
+            )
+        else:
+            results = build_study_results(study, conversions_by_group)
+
+        if sample_fraction < 1:
+            # group sizes and conversions are those of the sample, so the
+            # confidence intervals are wider than with the full study
+            results["partial"] = "true"
+            results["sample_fraction"] = str(round(sample_fraction, 4))
+
+        if cuped_pre_period_days:
+            print("Calculating CUPED adjusted metrics")
+            results.update(
+                build_cuped_results(study, count_cuped_flags_by_group(conversion_flags))
+            )
+    except Exception as e:
+        raise Exception(f"Error while calculating metrics for study {study_id}.", e)
 
-        # calculate cost per incremental conversion
-        incremental_conversions = (
-            test_results["conversions"] - control_results["conversions"]
-        )
-        cost_per_incremental_conv = calculate_cost_per_incremental_conversion(
-            avg_msg_cost, num_msgs, incremental_conversions
+    db.close()
+
+    return results
+
+
+async def get_lift_study_results_async(
+    study_id: str, conversion_event_name: str, **params
+):
+    """
+    Get results for a given lift study, reading its inputs concurrently.
+
+    For the conversions metric with study_window attribution, the study row is
+    read and validated first, so a request for an unknown or empty study fails
+    before any download starts. Then the conversions are downloaded and parsed in
+    a worker thread while the membership is read from the database, and members
+    are counted in another worker thread. The events table is read with its own
+    connection. Other requests run get_lift_study_results in a worker thread.
+
+    The sharded parsing of the events file forks worker processes, so it must not
+    run here, see get_coalesced_lift_study_results.
+
+    Args:
+        study_id (str): ID of the study to get results for.
+        conversion_event_name (str): Name of the conversion event (or keyword signal) to get results for.
+        **params: Other parameters of get_lift_study_results.
+
+    Returns:
+        results (dict): Results for the study, the same as get_lift_study_results.
+    """
+    conversion_source = params.get("conversion_source", "events_file")
+    if (
+        params.get("metric", "conversions") != "conversions"
+        or conversion_source == "signals"
+        or params.get("attribution", "study_window") != "study_window"
+        or params.get("cuped_pre_period_days")
+        or params.get("approximate")
+        or params.get("time_budget_seconds")
+    ):
+        return await asyncio.to_thread(
+            get_lift_study_results, study_id, conversion_event_name, **params
         )
+
+    conversions_task = None
+
+    try:
+        print("Connecting to database")
+        await asyncio.to_thread(db.connect, db_secret_arn, db_user, db_host, db_name)
+        try:
+            print("Fetching study data")
+            try:
+                study_metadata = await asyncio.to_thread(get_study_metadata, study_id)
+
+                assert (
+                    study_metadata.control_group_size > 0
+                    and study_metadata.test_group_size > 0
+                ), "Group sizes must be greater than 0."
+            except Exception as e:
+                raise Exception(f"Error while fetching data for study {study_id}.", e)
+
+            try:
+                if conversion_source == "events_table":
+                    conversions_task = asyncio.create_task(
+                        asyncio.to_thread(
+                            read_events_table_conversions,
+                            conversion_event_name,
+                            study_metadata.start_date,
+                            study_metadata.end_date,
+                        )
+                    )
+                else:
+                    conversions_task = asyncio.create_task(
+                        asyncio.to_thread(
+                            read_conversions,
+                            conversion_event_name,
+                            None,
+                            None,
+                            conversion_source,
+                        )
+                    )
+                membership = await asyncio.to_thread(
+                    get_study_membership,
+                    study_id,
+                    study_metadata.control_group_size,
+                    study_metadata.test_group_size,
+                    get_hash_assignment_salt(study_metadata),
+                )
+                conversions = await conversions_task
+
+                print("Counting converted members per group")
+                conversions_by_group = await asyncio.to_thread(
+                    count_member_conversions,
+                    conversions,
+                    study_metadata.start_date,
+                    study_metadata.end_date,
+                    conversion_event_name,
+                    membership,
+                )
+
+                assert sum(conversions_by_group.values()) > 0, (
+                    "No valid conversions found."
+                )
+            except Exception as e:
+                raise Exception(
+                    f"Error while fetching valid conversion events ({conversion_event_name}) for study {study_id}.",
+                    e,
+                )
+        finally:
+            db.close()
+    finally:
+        # a failed stage leaves the conversions read unawaited
+        if conversions_task is not None and not conversions_task.done():
+            conversions_task.cancel()
+
+    study = {
+        "name": study_metadata.name,
+        "start_date": study_metadata.start_date,
+        "end_date": study_metadata.end_date,
+        "sample_size": study_metadata.sample_size,
+        "control_group_size": study_metadata.control_group_size,
+        "test_group_size": study_metadata.test_group_size,
+        "messages_count": study_metadata.messages_count,
+        "avg_message_cost": study_metadata.avg_message_cost,
+    }
+
+    try:
+        print("Calculating metrics")
+        if study_metadata.arm_names:
+            return build_multi_arm_results(
+                study, conversions_by_group, membership.count()
+            )
+        return build_study_results(study, conversions_by_group)
     except Exception as e:
         raise Exception(f"Error while calculating metrics for study {study_id}.", e)
 
-    results = {
-        "name": study_name,
-        "start_date": start_date.strftime("%Y-%m-%d"),
-        "end_date": end_date.strftime("%Y-%m-%d"),
-        "sample_size": str(sample_size),
-        "test_num_conversions": str(test_results["conversions"]),
-        "test_group_size": str(test_group_size),
-        "test_conversion_rate": str(round(test_results["conversion_rate"], 4)),
-        "test_conversion_rate_confidence_interval": str(
-            test_results["confidence_interval"]
-        ),
-        "control_num_conversions": str(control_results["conversions"]),
-        "control_group_size": str(control_group_size),
-        "control_conversion_rate": str(round(control_results["conversion_rate"], 4)),
-        "control_conversion_rate_confidence_interval": str(
-            control_results["confidence_interval"]
-        ),
-        "lift": str(round(lift_perc, 4)),
-        "cost_per_incremental_conversion": str(round(cost_per_incremental_conv, 2)),
-        "p_value": str(round(p_value, 4)),
-    }
 
-    db.close()
+def read_events_table_conversions(conversion_event_name: str, start_date, end_date):
+    """
+    Read the conversions from the events table with a connection of its own, so
+    the module's connection can be used meanwhile.
 
-    return results
+    Args:
+        conversion_event_name (str): Name of the conversion event.
+        start_date (datetime.date): Start date of the conversions to read.
+        end_date (datetime.date): End date of the conversions to read.
+
+    Returns:
+        conversions (pandas.DataFrame): DataFrame containing the conversions.
+    """
+    events_db = LiftDatabaseHandler()
+    events_db.connect(db_secret_arn, db_user, db_host, db_name)
+    try:
+        return read_conversions(
+            conversion_event_name,
+            start_date,
+            end_date,
+            "events_table",
+            database=events_db,
+        )
+    finally:
+        events_db.close()
 
 
-def update_lift_study_data(study_id: str, request_data: dict):
+def sketches_handler(event, context):
     """
-    Update lift study data.
+    Scheduled Lambda handler that builds the daily converters sketches of the
+    running and recently ended studies.
 
     Args:
-        study_id (str): ID of the study to update.
-        request_data (dict): Data to update.
+        event (dict): Event data passed to the lambda function. An optional
+            conversion_events list overrides the SKETCH_CONVERSION_EVENTS variable.
+        context (Context): Runtime information of the lambda function.
 
     Returns:
-        updated_fields (dict): Dictionary containing the updated fields.
+        built (dict): Number of sketches built for each study.
     """
-    # connect to the database
+    conversion_event_names = event.get("conversion_events") or [
+        name for name in sketch_conversion_events.split(",") if name
+    ]
+    assert default_conversion_source != "signals", (
+        "Sketches are only available for conversions from events."
+    )
+
+    today = datetime.date.today()
     db.connect(db_secret_arn, db_user, db_host, db_name)
+    try:
+        studies = db.read_table(
+            "lift_studies",
+            columns=["id", "start_date", "end_date"],
+            filters="start_date <= %s AND end_date >= %s",
+            params=(today, today - datetime.timedelta(days=1)),
+        )
 
-    # check if the study exists
-    assert db.exists_study_with_id(study_id), f"Study {study_id} does not exist."
+        built = {}
+        for study in studies.to_dict(orient="records"):
+            built[study["id"]] = build_study_sketches(
+                study["id"],
+                study["start_date"],
+                min(study["end_date"], today),
+                conversion_event_names,
+            )
+    finally:
+        db.close()
 
-    updated_fields = {}
+    return built
 
-    if "status" in request_data:
-        new_status = request_data["status"]
-        active_study_id = db.get_active_study_id()
 
-        assert new_status in (
+def warm_up():
+    """
+    Preload what the first request of a container would otherwise wait for: the
+    lazily imported modules, the S3 client, the database password and connection,
+    the members of the active studies and the parsed events file.
+
+    Returns:
+        report (dict): Seconds taken by each warmed step, and the skipped steps.
+    """
+    report = {"warmed": {}, "skipped": []}
+
+    def step(name, warm):
+        started_at = time.monotonic()
+        result = warm()
+        report["warmed"][name] = round(time.monotonic() - started_at, 3)
+        return result
+
+    def warm_memberships():
+        study_ids = set(db.get_active_studies().values())
+        for study_id in study_ids:
+            study = get_study_metadata(study_id)
+            get_study_membership(
+                study_id,
+                study.control_group_size,
+                study.test_group_size,
+                get_hash_assignment_salt(study),
+            )
+        return len(study_ids)
+
+    step("imports", warm_imports)
+    step("s3_client", get_s3_handler)
+    step("database_password", lambda: db.get_database_password(db_secret_arn))
+    step(
+        "database_connection",
+        lambda: db.connect(db_secret_arn, db_user, db_host, db_name),
+    )
+    try:
+        report["active_studies"] = step("study_memberships", warm_memberships)
+    finally:
+        db.close()
+
+    # the sharded parsing streams the file instead of reading the cached one
+    if (
+        default_conversion_source == "events_file"
+        and events_file_cache_enabled
+        and events_parse_workers == 1
+    ):
+        report["events_file_rows"] = len(
+            step("events_file", get_events_file_conversions)
+        )
+    else:
+        report["skipped"].append("events_file")
+
+    print(f"Warmed up: {json.dumps(report)}")
+
+    return report
+
+
+def warm_imports():
+    """
+    Import the modules only imported when needed, and run the CSV parser once.
+    """
+    # only needed for zstd compressed files
+    import zstandard  # noqa: F401
+
+    read_conversions_csv(
+        [
+            b"event_name,event_time,user_name,user_phone\nPurchase,2024-01-01 00:00:00,user,+5511900000000\n"
+        ]
+    )
+
+
+def build_study_sketches(study_id: str, start_date, end_date, conversion_event_names):
+    """
+    Build and store the daily converters sketches of a study.
+
+    Days before the last one with sketches are complete and not built again.
+
+    Args:
+        study_id (str): ID of the study.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): Last day to build sketches for.
+        conversion_event_names (list): Names of the conversion events.
+
+    Returns:
+        num_sketches (int): Number of sketches built.
+    """
+    study = db.get_study_metadata(study_id)
+    membership = get_study_membership(
+        study_id,
+        study.control_group_size,
+        study.test_group_size,
+        get_hash_assignment_salt(study),
+    )
+
+    num_sketches = 0
+    for conversion_event_name in conversion_event_names:
+        from_date = db.get_latest_sketch_date(study_id, conversion_event_name)
+        from_date = max(from_date or start_date, start_date)
+
+        conversions = get_conversions_in_window(
+            read_conversions(
+                conversion_event_name,
+                from_date,
+                end_date,
+                default_conversion_source,
+                with_event_time=True,
+            ),
+            from_date,
+            end_date,
+            conversion_event_name,
+        )
+
+        print(f"Building {conversion_event_name} sketches from {from_date}")
+        sketches = build_daily_sketches(conversions, membership)
+        for (day, group_name), sketch in sketches.items():
+            db.upsert_study_sketch(
+                study_id,
+                group_name,
+                conversion_event_name,
+                day,
+                sketch.to_bytes(),
+                commit=False,
+            )
+        db.commit()
+        num_sketches += len(sketches)
+
+    return num_sketches
+
+
+def read_conversions(
+    conversion_event_name: str,
+    start_date,
+    end_date,
+    conversion_source: str,
+    with_event_time: bool = False,
+    sample_fraction: float = None,
+    database: LiftDatabaseHandler = None,
+):
+    """
+    Read the conversions from the given source.
+
+    Args:
+        conversion_event_name (str): Name of the conversion event.
+        start_date (datetime.date): Start date of the conversions to read.
+        end_date (datetime.date): End date of the conversions to read.
+        conversion_source (str): Where to read conversions from, either "events_file" or "events_table".
+        with_event_time (bool): Whether or not the time of each event is needed when
+            reading from the events table. Defaults to False.
+        sample_fraction (float): From the events table, fraction of a consistent sample
+            of the phone numbers to read the conversions of, see in_phone_sample.
+            Defaults to None (all).
+        database (LiftDatabaseHandler): Connected handler to read the events table
+            with. Defaults to None (the module's handler).
+
+    Returns:
+        conversions (pandas.DataFrame): DataFrame containing the conversions. The events
+            file is read whole, and has to be filtered by event name and time.
+    """
+    if conversion_source == "events_table":
+        print("Reading conversions from events table")
+        return (database or db).get_conversions_from_events_table(
+            conversion_event_name,
+            start_date,
+            end_date,
+            with_event_time=with_event_time,
+            phone_sample=(
+                (
+                    PHONE_SAMPLE_MODULUS,
+                    PHONE_SAMPLE_MULTIPLIER,
+                    get_phone_sample_threshold(sample_fraction),
+                )
+                if sample_fraction
+                else None
+            ),
+        )
+
+    assert not sample_fraction, "Only conversions from the events table are sampled."
+
+    print(f"Reading conversions from {events_file_key} file in S3")
+    return get_events_file_conversions()
+
+
+def get_events_file_conversions():
+    """
+    Get the conversions of the whole events file, reused by the requests of a warm
+    container while the ETag of the file does not change.
+
+    Returns:
+        conversions (pandas.DataFrame): DataFrame containing the events file. It is
+            shared between requests, and must not be modified.
+    """
+    global _events_file_cache
+
+    s3 = get_s3_handler()
+    etag = s3.get_file_etag(bucket_name, events_file_key)
+    if _events_file_cache and _events_file_cache[0] == etag:
+        print(f"Reusing the parsed {events_file_key} file")
+        return _events_file_cache[1]
+
+    # release the outdated file before the new one is parsed
+    _events_file_cache = None
+    conversions = s3.get_conversions_from_s3(bucket_name, events_file_key)
+    if events_file_cache_enabled:
+        _events_file_cache = (etag, conversions)
+
+    return conversions
+
+
+def count_events_file_members(
+    start_date, end_date, conversion_event_name: str, membership
+) -> dict:
+    """
+    Count the members of each group with a conversion in the events file, parsed
+    by events_parse_workers worker processes.
+
+    Args:
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        conversion_event_name (str): Name of the conversion event.
+        membership (StudyMembership): Members of each group of the study.
+
+    Returns:
+        conversions_by_group (dict): Number of conversions for each group name.
+    """
+    print(f"Parsing {events_file_key} file in S3 with {events_parse_workers} workers")
+    s3 = get_s3_handler()
+
+    return count_member_conversions_sharded(
+        s3.stream_file(bucket_name, events_file_key),
+        start_date,
+        end_date,
+        conversion_event_name,
+        membership,
+        events_parse_workers,
+    )
+
+
+def get_sample_fraction(
+    conversion_event_name: str,
+    start_date,
+    end_date,
+    time_budget_seconds: float,
+) -> float:
+    """
+    Get the fraction of the phone numbers whose conversions can be read from the
+    events table within a time budget, from the number of conversions to read.
+
+    Args:
+        conversion_event_name (str): Name of the conversion event.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        time_budget_seconds (float): Time left to read the conversions.
+
+    Returns:
+        sample_fraction (float): 1 if every conversion can be read, or the fraction of
+            the phone numbers to sample, at least MIN_SAMPLE_FRACTION.
+    """
+    read_seconds = (
+        db.count_conversion_events(conversion_event_name, start_date, end_date)
+        / events_table_rows_per_second
+    )
+    print(f"Estimated {read_seconds:.1f}s to read conversions")
+
+    if read_seconds <= time_budget_seconds:
+        return 1.0
+
+    return max(time_budget_seconds / read_seconds, MIN_SAMPLE_FRACTION)
+
+
+def get_s3_handler():
+    """
+    Get the S3 handler of the container, created by its first request.
+
+    Returns:
+        s3 (LiftS3Handler): S3 handler.
+    """
+    global _s3_handler
+
+    if _s3_handler is None:
+        _s3_handler = LiftS3Handler()
+
+    return _s3_handler
+
+
+def get_study_membership(
+    study_id: str, control_group_size, test_group_size, assignment_salt: str = None
+):
+    """
+    Get the members of each group of a study, from the cache if they did not change.
+
+    Members are only ever added together with an increment of the group sizes,
+    so the sizes identify a version of the membership. Only the latest version of
+    each study is kept in the cache.
+
+    Args:
+        study_id (str): ID of the study.
+        control_group_size (int): Size of the control group.
+        test_group_size (int): Size of the test group.
+        assignment_salt (str): Assignment salt of a study in the hash assignment mode,
+            whose groups are computed from the phone numbers instead of being read.
+            Defaults to None.
+
+    Returns:
+        membership (StudyMembership): Members of each group of the study.
+    """
+    cache_path = os.path.join(
+        membership_cache_dir,
+        f"lift_membership_{study_id}_{control_group_size}_{test_group_size}.bin",
+    )
+    if os.path.exists(cache_path):
+        print(f"Reading study membership from {cache_path}")
+        with open(cache_path, "rb") as f:
+            return StudyMembership.from_bytes(f.read())
+
+    print("Reading study groups table")
+    batches = db.iter_study_group_batches(
+        study_id, with_group_name=assignment_salt is None
+    )
+    if assignment_salt is not None:
+        batches = label_hash_groups(batches, study_id, assignment_salt)
+    membership = StudyMembership.from_batches(batches)
+
+    try:
+        # drop the outdated versions, so /tmp does not fill up as the groups grow
+        for outdated_path in glob.glob(
+            os.path.join(membership_cache_dir, f"lift_membership_{study_id}_*.bin")
+        ):
+            os.remove(outdated_path)
+        with open(cache_path, "wb") as f:
+            f.write(membership.to_bytes())
+    except OSError as e:
+        print(f"Could not cache study membership: {e}")
+
+    return membership
+
+
+def label_hash_groups(batches, study_id: str, assignment_salt: str):
+    """
+    Add the groups of the hash assignment mode to batches of study members.
+
+    Args:
+        batches (iterable): Dicts with the phone_number array of each batch.
+        study_id (str): ID of the study.
+        assignment_salt (str): Assignment salt of the study.
+
+    Returns:
+        batches (iterator): Dicts with the phone_number and group_name arrays of each
+            batch.
+    """
+    for batch in batches:
+        # normalize phone numbers to include digits only
+        phone_numbers = (
+            pd.Series(batch["phone_number"], dtype=object)
+            .astype(str)
+            .str.replace(r"[^0-9]", "", regex=True)
+        )
+        yield {
+            "phone_number": phone_numbers.to_numpy(),
+            "group_name": assign_groups_by_hash(
+                phone_numbers, study_id, assignment_salt
+            ),
+        }
+
+
+def get_valid_conversions(
+    study_id: str,
+    conversion_event_name: str,
+    start_date,
+    end_date,
+    conversion_source: str,
+    attribution: str,
+    attribution_window_hours: float,
+    pre_period_days: int = None,
+    assignment_salt: str = None,
+):
+    """
+    Get the conversions of a given event made by members of a lift study.
+
+    If pre_period_days is given, conversions in the days before the study are read
+    in the same pass, and each member is flagged for whether they converted during
+    the study and during the pre-period.
+
+    Args:
+        study_id (str): ID of the study.
+        conversion_event_name (str): Name of the conversion event.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        conversion_source (str): Where to read conversions from, either "events_file" or "events_table".
+        attribution (str): Attribution mode, one of ATTRIBUTION_MODES.
+        attribution_window_hours (float): In exposure mode, maximum hours between the
+            assignment and the conversion.
+        pre_period_days (int): Number of days before the study to read conversions for.
+            Defaults to None (no pre-period).
+        assignment_salt (str): Assignment salt of a study in the hash assignment mode,
+            used to compute the groups instead of reading them. Defaults to None.
+
+    Returns:
+        valid_conversions (pandas.DataFrame): DataFrame containing all valid conversions,
+            with in_study and pre_period flags if pre_period_days is given.
+    """
+    read_start_date = start_date
+    if pre_period_days:
+        read_start_date = start_date - datetime.timedelta(days=pre_period_days)
+
+    conversions = read_conversions(
+        conversion_event_name,
+        read_start_date,
+        end_date,
+        conversion_source,
+        with_event_time=attribution == "exposure" or bool(pre_period_days),
+    )
+
+    print("Reading study groups table")
+    columns = ["phone_number", "assigned_at"]
+    if assignment_salt is None:
+        columns.insert(1, "group_name")
+    study_groups = db.read_table(
+        "lift_studies_groups",
+        columns=columns,
+        filters="study_id = %s",
+        params=(study_id,),
+        batched=True,
+    )
+    # normalize phone numbers to include digits only
+    study_groups.loc[:, "phone_number"] = study_groups["phone_number"].str.replace(
+        r"[^0-9]", "", regex=True
+    )
+    if assignment_salt is not None:
+        # the groups of hash assigned studies are computed from the phone numbers
+        study_groups.insert(
+            1,
+            "group_name",
+            assign_groups_by_hash(
+                study_groups["phone_number"], study_id, assignment_salt
+            ),
+        )
+
+    print("Filtering valid conversions")
+    if pre_period_days:
+        return filter_conversions_with_pre_period(
+            conversions,
+            start_date,
+            end_date,
+            pre_period_days,
+            conversion_event_name,
+            study_groups[["phone_number", "group_name"]],
+        )
+
+    if attribution == "exposure":
+        return filter_exposed_conversions(
+            conversions,
+            start_date,
+            end_date,
+            conversion_event_name,
+            study_groups,
+            attribution_window=(
+                pd.Timedelta(hours=attribution_window_hours)
+                if attribution_window_hours
+                else None
+            ),
+        )
+
+    return filter_conversions(
+        conversions,
+        start_date,
+        end_date,
+        conversion_event_name,
+        study_groups[["phone_number", "group_name"]],
+    )
+
+
+def get_value_sums_by_group(
+    study_id: str, conversion_event_name: str, start_date, end_date
+):
+    """
+    Get the running sums of the conversion value per member of each study group.
+
+    The per-user values are streamed from the events table in batches and added
+    to the sums of the member's group, in a single pass.
+
+    Args:
+        study_id (str): ID of the study.
+        conversion_event_name (str): Name of the conversion event.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+
+    Returns:
+        value_sums_by_group (dict): Running sums for each group name, see accumulate_value_sums.
+    """
+    print("Reading study groups table")
+    study_groups = db.read_table(
+        "lift_studies_groups",
+        columns=["phone_number", "group_name"],
+        filters="study_id = %s",
+        params=(study_id,),
+        batched=True,
+    )
+    # normalize phone numbers to include digits only
+    phone_groups = pd.Series(
+        study_groups["group_name"].to_numpy(),
+        index=study_groups["phone_number"].str.replace(r"[^0-9]", "", regex=True),
+    )
+    phone_groups = phone_groups[~phone_groups.index.duplicated()]
+
+    print("Streaming conversion values from events table")
+    value_sums_by_group = {}
+    for batch in db.iter_user_conversion_values(
+        conversion_event_name, start_date, end_date
+    ):
+        group_names = pd.Series(batch["user_phone"]).map(phone_groups).to_numpy()
+        accumulate_value_sums(value_sums_by_group, group_names, batch["value"])
+
+    return value_sums_by_group
+
+
+def get_study_update_fields(request_data: dict) -> dict:
+    """
+    Validate the data of a study update.
+
+    Args:
+        request_data (dict): Data to update.
+
+    Returns:
+        fields (dict): Values to set, by column name.
+    """
+    fields = {}
+
+    if "status" in request_data:
+        assert request_data["status"] in (
             "active",
             "paused",
         ), "Status must be either 'active' or 'paused'."
-        # run the code if its not trying to activate an active study or pause a paused study
-        if not (
-            (new_status == "active" and active_study_id == study_id)
-            or (new_status == "paused" and active_study_id != study_id)
-        ):
-            if new_status == "active":
-                assert active_study_id is None, (
-                    "There is already an active study running."
-                )
-
-            db.update_lift_study_data(study_id, "status", new_status)
-            updated_fields["status"] = new_status
+        fields["status"] = request_data["status"]
 
     if "avg_message_cost" in request_data:
-        new_avg_msg_cost = request_data["avg_message_cost"]
-        db.update_lift_study_data(study_id, "avg_message_cost", float(new_avg_msg_cost))
-        updated_fields["avg_message_cost"] = new_avg_msg_cost
+        fields["avg_message_cost"] = float(request_data["avg_message_cost"])
 
     if "template_names" in request_data:
         new_templates = request_data["template_names"]
         assert all(validate_template_name(tn) for tn in new_templates.split(",")), (
             "Template name must be composed by lowercase letters, numbers, and underscores."
         )
-        db.update_lift_study_data(study_id, "template_names", new_templates)
-        updated_fields["template_names"] = new_templates
+        fields["template_names"] = new_templates
 
-    db.close()
+    return fields
+
+
+def update_lift_study_data(updates: list):
+    """
+    Update lift study data.
+
+    Every update is validated first, then all of them are applied in a single
+    transaction, with one UPDATE statement per study.
+
+    Args:
+        updates (list): Pairs of the ID of a study to update and its data to update.
+
+    Returns:
+        updated_fields (dict): Dictionary containing the updated fields of each study.
+    """
+    study_ids = [study_id for study_id, _ in updates]
+    assert all(study_ids), "Study ID must be specified for every update."
+    assert len(set(study_ids)) == len(study_ids), "Study IDs must be unique."
+    study_fields = [
+        (study_id, get_study_update_fields(request_data))
+        for study_id, request_data in updates
+    ]
+
+    # connect to the database
+    db.connect(db_secret_arn, db_user, db_host, db_name)
+    db.begin_transaction()
+    try:
+        # lock the studies that are not paused, so concurrent creations and
+        # activations wait for this transaction
+        scheduled_studies = db.get_scheduled_studies(for_update=True)
+
+        updated_fields = {}
+        for study_id, fields in study_fields:
+            # check if the study exists, and lock it
+            study = db.get_study_metadata(study_id, for_update=True)
+            assert study is not None, f"Study {study_id} does not exist."
+
+            # skip activating an active study or pausing a paused study
+            if fields.get("status") == study.status:
+                del fields["status"]
+
+            # the arms of a multi-arm study are named after their template
+            if study.arm_names and "template_names" in fields:
+                assert set(fields["template_names"].split(",")) == set(
+                    study.arm_names.split(",")
+                ), f"Template names of study {study_id} must be its arm names."
+
+            # studies that are not paused must not share templates on the same days
+            scheduled_studies.pop(study_id, None)
+            if fields.get("status", study.status) == "active":
+                template_names = [
+                    name
+                    for name in fields.get(
+                        "template_names", study.template_names or ""
+                    ).split(",")
+                    if name
+                ]
+                check_templates_available(
+                    study_id,
+                    template_names,
+                    study.start_date,
+                    study.end_date,
+                    scheduled_studies,
+                )
+                scheduled_studies[study_id] = (
+                    study.start_date,
+                    study.end_date,
+                    template_names,
+                )
+
+            if fields:
+                db.update_lift_study_data(study_id, fields, commit=False)
+            updated_fields[study_id] = fields
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    for study_id in study_ids:
+        invalidate_study_metadata(study_id)
 
     return updated_fields
 
@@ -358,6 +1878,47 @@ def validate_template_name(template_name):
     ) or template_name.isnumeric()
 
 
+def get_header(event, name):
+    """
+    Get a request header, whatever its case.
+
+    Args:
+        event (dict): Event data passed to the lambda function.
+        name (str): Name of the header.
+
+    Returns:
+        value (str): Value of the header, or None if it is not set.
+    """
+    headers = event.get("headers", None) or {}
+
+    return next(
+        (value for key, value in headers.items() if key.lower() == name.lower()),
+        None,
+    )
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check if an If-None-Match header matches an entity tag.
+
+    Args:
+        if_none_match (str): Value of the If-None-Match header, may be None.
+        etag (str): Quoted entity tag.
+
+    Returns:
+        matches (bool): Whether or not the client has the tagged representation.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    # weak comparison, as API Gateway may weaken tags of compressed responses
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
+
+
 def abort(code, message):
     """
     Format error code and message.
@@ -376,3 +1937,11 @@ def abort(code, message):
         },
         "body": message,
     }
+
+
+if warm_up_on_init:
+    # provisioned concurrency runs the init phase before any request
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Could not warm up: {e}")
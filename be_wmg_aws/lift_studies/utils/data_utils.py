@@ -3,14 +3,181 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import gzip
+import io
+import itertools
 import json
 import os
-from io import StringIO
 
 import boto3
 import mysql.connector
+import numpy as np
 import pandas as pd
 
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+STREAM_CHUNK_SIZE = 1024 * 1024
+FETCH_BATCH_SIZE = 50000
+DATE_COLUMNS = ("start_date", "end_date")
+INSERT_BATCH_SIZE = 5000
+AUDIENCE_PHONE_COLUMNS = ("phone_number", "user_phone", "phone", "ph")
+
+
+class ChunkedStream(io.RawIOBase):
+    """
+    Read-only file-like object over an iterator of byte chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b""
+                return 0
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def open_decompressed_stream(chunks):
+    """
+    Wrap a stream of raw file bytes with the matching streaming decompressor.
+
+    The compression format is detected from the magic bytes at the start of the
+    stream, so plain, gzip and zstd files can be read through the same path.
+    Bytes are only decompressed as the consumer reads them.
+
+    Args:
+        chunks (iterable): Iterable of bytes chunks with the raw file content.
+
+    Returns:
+        stream (io.BufferedIOBase): Binary file-like object with the decompressed content.
+    """
+    chunks = iter(chunks)
+    head = b""
+    # the first chunk may be shorter than the magic number
+    while len(head) < len(ZSTD_MAGIC):
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        head += chunk
+
+    raw = io.BufferedReader(
+        ChunkedStream(itertools.chain([head], chunks)), buffer_size=STREAM_CHUNK_SIZE
+    )
+
+    if head.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if head.startswith(ZSTD_MAGIC):
+        # only needed for zstd compressed files
+        import zstandard
+
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(
+                raw, read_size=STREAM_CHUNK_SIZE
+            ),
+            buffer_size=STREAM_CHUNK_SIZE,
+        )
+    return raw
+
+
+def stream_local_file(path: str):
+    """
+    Stream the raw bytes of a local file.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        chunks (iterator): Iterator of bytes chunks.
+    """
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(STREAM_CHUNK_SIZE), b"")
+
+
+def read_conversions_csv(stream) -> pd.DataFrame:
+    """
+    Parse conversion data from a (possibly compressed) CSV stream.
+
+    Args:
+        stream (iterable): Iterable of bytes chunks with the raw file content.
+
+    Returns:
+        conversions (pandas.DataFrame): DataFrame containing the conversion data.
+    """
+    with open_decompressed_stream(stream) as data:
+        conversions = normalize_user_phones(pd.read_csv(data))
+    conversions["event_time"] = pd.to_datetime(conversions["event_time"])
+
+    return conversions
+
+
+def normalize_user_phones(conversions: pd.DataFrame) -> pd.DataFrame:
+    """
+    Normalize the phone numbers of conversion data to include digits only.
+
+    Args:
+        conversions (pandas.DataFrame): DataFrame containing the conversion data.
+
+    Returns:
+        conversions (pandas.DataFrame): The same DataFrame, with normalized user_phone.
+    """
+    conversions["user_phone"] = (
+        conversions["user_phone"].astype(str).str.replace(r"[^0-9]", "", regex=True)
+    )
+
+    return conversions
+
+
+def read_audience_csv(stream) -> pd.Series:
+    """
+    Parse the phone numbers of an audience from a (possibly compressed) CSV stream.
+
+    The phone numbers are read from the first column named as one of
+    AUDIENCE_PHONE_COLUMNS, or from the first column if none of them exists.
+
+    Args:
+        stream (iterable): Iterable of bytes chunks with the raw file content.
+
+    Returns:
+        phone_numbers (pandas.Series): Phone numbers of the audience, as in the file.
+    """
+    with open_decompressed_stream(stream) as data:
+        audience = pd.read_csv(data, dtype=str, keep_default_na=False)
+
+    phone_col = next(
+        (col for col in AUDIENCE_PHONE_COLUMNS if col in audience.columns),
+        audience.columns[0],
+    )
+
+    return audience[phone_col]
+
+
+def get_event_time_range(start_date, end_date):
+    """
+    Get the range of event_time values within the study's timeframe.
+
+    Args:
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+
+    Returns:
+        start_ts (int): First unix timestamp (seconds) of the range.
+        end_ts (int): Unix timestamp (seconds) right after the end of the range.
+    """
+    start_ts = int(pd.Timestamp(start_date, tz="UTC").timestamp())
+    end_ts = int((pd.Timestamp(end_date, tz="UTC") + pd.Timedelta(days=1)).timestamp())
+
+    return start_ts, end_ts
+
 
 class LiftS3Handler:
     """
@@ -37,10 +204,41 @@ class LiftS3Handler:
 
         return data
 
+    def stream_file(self, bucket: str, file_key: str):
+        """
+        Stream the raw bytes of a file from S3.
+
+        Args:
+            bucket (str): Bucket name.
+            file_key (str): File key.
+
+        Returns:
+            chunks (iterator): Iterator of bytes chunks, read as they arrive.
+        """
+        s3_object = self.client.get_object(Bucket=bucket, Key=file_key)
+
+        return s3_object["Body"].iter_chunks(chunk_size=STREAM_CHUNK_SIZE)
+
+    def get_file_etag(self, bucket: str, file_key: str) -> str:
+        """
+        Get the ETag of a file in S3, which changes whenever the file is rewritten.
+
+        Args:
+            bucket (str): Bucket name.
+            file_key (str): File key.
+
+        Returns:
+            etag (str): ETag of the file.
+        """
+        return self.client.head_object(Bucket=bucket, Key=file_key)["ETag"]
+
     def get_conversions_from_s3(self, bucket: str, file_key: str):
         """
         Read a file with conversion data from S3.
 
+        The file may be plain, gzip or zstd compressed CSV. It is decompressed
+        and parsed chunk by chunk while it is downloaded.
+
         Args:
             bucket (str): Bucket name.
             file_key (str): File key.
@@ -48,15 +246,43 @@ class LiftS3Handler:
         Returns:
             conversions (pandas.DataFrame): DataFrame containing the conversion data.
         """
-        data = self.read_file(bucket, file_key)
-        conversions = pd.read_csv(StringIO(data))
-        conversions["event_time"] = pd.to_datetime(conversions["event_time"])
-        # normalize phone numbers to include digits only
-        conversions["user_phone"] = (
-            conversions["user_phone"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-        )
+        return read_conversions_csv(self.stream_file(bucket, file_key))
 
-        return conversions
+
+class StudyMetadata:
+    """
+    Row of the lift_studies table.
+    """
+
+    __slots__ = (
+        "id",
+        "name",
+        "start_date",
+        "end_date",
+        "sample_size",
+        "template_names",
+        "control_group_size",
+        "test_group_size",
+        "messages_count",
+        "avg_message_cost",
+        "status",
+        "assignment_mode",
+        "assignment_salt",
+        "arm_names",
+    )
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def to_dict(self) -> dict:
+        """
+        Get the fields of the study.
+
+        Returns:
+            study (dict): Value of each field, by column name.
+        """
+        return {field: getattr(self, field) for field in self.__slots__}
 
 
 class LiftDatabaseHandler:
@@ -64,8 +290,18 @@ class LiftDatabaseHandler:
     Class for handling lift study data.
     """
 
-    def __init__(self):
+    # secret ARN -> database password, shared by the handlers of a container
+    _passwords = {}
+
+    def __init__(self, keep_alive: bool = False):
+        """
+        Args:
+            keep_alive (bool): Whether or not to keep the connection open when it is
+                closed, to reuse it in the next invocations of a warm container.
+                Defaults to False.
+        """
         self.conn = None
+        self.keep_alive = keep_alive
         self.region = os.environ["AWS_REGION"]  # noqa: F821
 
     def __del__(self):
@@ -73,11 +309,11 @@ class LiftDatabaseHandler:
         When the object is deleted, close the connection to the database if it exists.
         """
         if getattr(self, "conn", None) is not None:
-            self.close()
+            self.conn.close()
 
     def connect(self, db_secret_arn: str, db_user: str, db_host: str, db_name: str):
         """
-        Open a connection to the database.
+        Open a connection to the database, or reuse the kept alive one.
 
         Args:
             db_secret_arn (str): ARN of the secret containing the database password.
@@ -85,27 +321,81 @@ class LiftDatabaseHandler:
             db_host (str): Hostname of the database.
             db_name (str): Name of the database.
         """
-        db_pass = self.get_database_password(db_secret_arn)
-        self.conn = mysql.connector.connect(
-            user=db_user, password=db_pass, host=db_host, database=db_name
-        )
+        if self.keep_alive and self.conn is not None:
+            try:
+                # ends what a failed request left open, and checks the connection
+                self.conn.rollback()
+                return
+            except mysql.connector.Error as e:
+                print(f"Reconnecting to the database: {e}")
+                self.conn = None
+
+        try:
+            self.conn = mysql.connector.connect(
+                user=db_user,
+                password=self.get_database_password(db_secret_arn),
+                host=db_host,
+                database=db_name,
+            )
+        except mysql.connector.errors.ProgrammingError:
+            # the cached password may have been rotated
+            self.conn = mysql.connector.connect(
+                user=db_user,
+                password=self.get_database_password(db_secret_arn, refresh=True),
+                host=db_host,
+                database=db_name,
+            )
 
     def close(self):
         """
-        Close connection to the database.
+        Close connection to the database. A kept alive connection is only rolled back
+        to the end of its last transaction.
         """
-        self.conn.close()
+        if not self.keep_alive:
+            self.conn.close()
+            return
+        if self.conn is None:
+            return
+
+        try:
+            self.conn.rollback()
+        except mysql.connector.Error as e:
+            print(f"Dropping the database connection: {e}")
+            self.conn = None
 
-    def get_database_password(self, db_secret_arn: str) -> str:
+    def begin_transaction(self):
+        """
+        Start a transaction, committed with commit or discarded with rollback.
         """
-        Get the password for the database.
+        self.conn.start_transaction()
+
+    def commit(self):
+        """
+        Commit the current transaction.
+        """
+        self.conn.commit()
+
+    def rollback(self):
+        """
+        Roll back the current transaction.
+        """
+        self.conn.rollback()
+
+    def get_database_password(self, db_secret_arn: str, refresh: bool = False) -> str:
+        """
+        Get the password for the database, fetched once per container.
 
         Args:
             db_secret_arn (str): ARN of the secret containing the database password.
+            refresh (bool): Whether or not to fetch the password again, when it was
+                rotated. Defaults to False.
 
         Returns:
             password (str): Password for the database.
         """
+        if not refresh and db_secret_arn in self._passwords:
+            return self._passwords[db_secret_arn]
+
         try:
             print("Getting password")
             client = boto3.client("secretsmanager", region_name=self.region)  # noqa: F821
@@ -113,10 +403,11 @@ class LiftDatabaseHandler:
             print("Parsing password")
             if "SecretString" in data:
                 secret = json.loads(data["SecretString"])
-                return secret["password"]
+                password = secret["password"]
             else:
-                decoded_binary_secret = data["SecretBinary"].decode("base64")
-                return decoded_binary_secret
+                password = data["SecretBinary"].decode("base64")
+            self._passwords[db_secret_arn] = password
+            return password
         except Exception as e:
             print(e)
             raise e
@@ -147,77 +438,869 @@ class LiftDatabaseHandler:
 
         return result, cols
 
-    def read_table(self, table: str, filters: str = "") -> pd.DataFrame:
+    def iter_batches(
+        self,
+        query: str,
+        params: tuple = (),
+        dtypes: dict = None,
+        batch_size: int = FETCH_BATCH_SIZE,
+    ):
+        """
+        Execute a MySQL query and stream its rows in batches of NumPy column arrays.
+
+        Rows are read with an unbuffered cursor, so the full result set is never
+        held as Python tuples at once.
+
+        Args:
+            query (str): Query to be executed.
+            params (tuple): Parameters to be used in the query. Defaults to an empty tuple.
+            dtypes (dict): NumPy dtype of each column. Defaults to object for any column not given.
+            batch_size (int): Number of rows fetched per round trip.
+
+        Returns:
+            batches (iterator): Dicts of column name to NumPy array with the values of
+                the batch. An empty result yields a single batch of empty arrays.
+        """
+        dtypes = dtypes or {}
+        cursor = self.conn.cursor(buffered=False)
+        try:
+            cursor.execute(query, params)
+            cols = cursor.column_names
+            empty = True
+            while rows := cursor.fetchmany(batch_size):
+                empty = False
+                yield {
+                    col: np.fromiter(
+                        (row[i] for row in rows),
+                        dtype=dtypes.get(col, object),
+                        count=len(rows),
+                    )
+                    for i, col in enumerate(cols)
+                }
+            if empty:
+                yield {col: np.empty(0, dtype=dtypes.get(col, object)) for col in cols}
+        finally:
+            cursor.close()
+
+    def fetch_arrays(
+        self,
+        query: str,
+        params: tuple = (),
+        dtypes: dict = None,
+        batch_size: int = FETCH_BATCH_SIZE,
+    ) -> dict:
+        """
+        Execute a MySQL query and stream its rows into one NumPy array per column.
+
+        Args:
+            query (str): Query to be executed.
+            params (tuple): Parameters to be used in the query. Defaults to an empty tuple.
+            dtypes (dict): NumPy dtype of each column. Defaults to object for any column not given.
+            batch_size (int): Number of rows fetched per round trip.
+
+        Returns:
+            arrays (dict): Column name to NumPy array with the column values.
+        """
+        batches = list(self.iter_batches(query, params, dtypes, batch_size))
+
+        return {
+            col: np.concatenate([batch[col] for batch in batches]) for col in batches[0]
+        }
+
+    def get_conversions_from_events_table(
+        self,
+        conversion_event_name: str,
+        start_date,
+        end_date,
+        with_event_time: bool = False,
+        phone_sample: tuple = None,
+    ) -> pd.DataFrame:
+        """
+        Read the conversions of a given event within the study's timeframe from the events table.
+
+        Event name and time filters run in the database, so only the matching
+        rows are transferred.
+
+        Args:
+            conversion_event_name (str): Name of the conversion event.
+            start_date (datetime.date): Start date of the study.
+            end_date (datetime.date): End date of the study.
+            with_event_time (bool): Whether or not to read the time of each event.
+                Defaults to False, in which case every event is dated at start_date.
+            phone_sample (tuple): Modulus, multiplier and threshold of a consistent
+                sample of the phone numbers to read, see lift_utils.in_phone_sample.
+                Defaults to None (all phone numbers).
+
+        Returns:
+            conversions (pandas.DataFrame): DataFrame containing the conversion data.
+        """
+        start_ts, end_ts = get_event_time_range(start_date, end_date)
+
+        columns = "user_phone, event_time" if with_event_time else "user_phone"
+        params = (conversion_event_name, start_ts, end_ts)
+        sample_filter = ""
+        if phone_sample:
+            sample_filter = """
+            AND MOD(
+                MOD(CAST(REGEXP_REPLACE(user_phone, '[^0-9]', '') AS UNSIGNED), %s) * %s,
+                %s
+            ) < %s"""
+            modulus, multiplier, threshold = phone_sample
+            params += (modulus, multiplier, modulus, threshold)
+        query = f"""
+            SELECT {columns}
+            FROM events
+            WHERE event_name = %s
+            AND event_time >= %s
+            AND event_time < %s{sample_filter};
+        """
+        arrays = self.fetch_arrays(query, params, dtypes={"event_time": np.int64})
+
+        conversions = pd.DataFrame(
+            {
+                "event_name": conversion_event_name,
+                "event_time": (
+                    pd.to_datetime(arrays["event_time"], unit="s")
+                    if with_event_time
+                    else pd.Timestamp(start_date)
+                ),
+                "user_phone": arrays["user_phone"],
+            },
+            index=pd.RangeIndex(len(arrays["user_phone"])),
+        )
+        # normalize phone numbers to include digits only
+        conversions["user_phone"] = (
+            conversions["user_phone"].astype(str).str.replace(r"[^0-9]", "", regex=True)
+        )
+
+        return conversions
+
+    def count_conversion_events(
+        self, conversion_event_name: str, start_date, end_date
+    ) -> int:
+        """
+        Count the events of a given event name within the study's timeframe.
+
+        Args:
+            conversion_event_name (str): Name of the conversion event.
+            start_date (datetime.date): Start date of the study.
+            end_date (datetime.date): End date of the study.
+
+        Returns:
+            num_events (int): Number of events.
+        """
+        start_ts, end_ts = get_event_time_range(start_date, end_date)
+
+        query = """
+            SELECT COUNT(*)
+            FROM events
+            WHERE event_name = %s
+            AND event_time >= %s
+            AND event_time < %s;
+        """
+        num_events, _ = self.execute_query(
+            query, params=(conversion_event_name, start_ts, end_ts)
+        )
+
+        return int(num_events[0][0])
+
+    def get_conversion_events_version(
+        self, conversion_event_name: str, start_date, end_date
+    ) -> tuple:
+        """
+        Get a version of the events of a given event name within a timeframe.
+
+        Events are only appended, so their count and latest time change whenever an
+        event is added. Both are read from the (event_name, event_time) index.
+
+        Args:
+            conversion_event_name (str): Name of the conversion event.
+            start_date (datetime.date): Start date of the timeframe.
+            end_date (datetime.date): End date of the timeframe.
+
+        Returns:
+            version (tuple): Number of events and latest event time.
+        """
+        start_ts, end_ts = get_event_time_range(start_date, end_date)
+
+        query = """
+            SELECT COUNT(*), MAX(event_time)
+            FROM events
+            WHERE event_name = %s
+            AND event_time >= %s
+            AND event_time < %s;
+        """
+        version, _ = self.execute_query(
+            query, params=(conversion_event_name, start_ts, end_ts)
+        )
+
+        return tuple(version[0])
+
+    def get_signals_version(self) -> int:
+        """
+        Get a version of the signals table, its latest signal ID.
+
+        Returns:
+            version (int): Latest signal ID, or None if there are no signals.
+        """
+        version, _ = self.execute_query("SELECT MAX(id) FROM signals;")
+
+        return version[0][0]
+
+    def iter_user_conversion_values(
+        self, conversion_event_name: str, start_date, end_date
+    ):
+        """
+        Stream the total conversion value of each converting user from the events table.
+
+        The value is extracted from custom_data.value of the stored event payload
+        and summed per user in the database.
+
+        Args:
+            conversion_event_name (str): Name of the conversion event.
+            start_date (datetime.date): Start date of the study.
+            end_date (datetime.date): End date of the study.
+
+        Returns:
+            batches (iterator): Dicts with the user_phone (digits only) and value arrays of each batch.
+        """
+        start_ts, end_ts = get_event_time_range(start_date, end_date)
+
+        query = """
+            SELECT
+                REGEXP_REPLACE(user_phone, '[^0-9]', '') AS user_phone,
+                SUM(COALESCE(
+                    CAST(event_raw_data->>'$.custom_data.value' AS DECIMAL(18, 4)), 0
+                )) AS value
+            FROM events
+            WHERE event_name = %s
+            AND event_time >= %s
+            AND event_time < %s
+            GROUP BY 1;
+        """
+
+        return self.iter_batches(
+            query,
+            (conversion_event_name, start_ts, end_ts),
+            dtypes={"value": np.float64},
+        )
+
+    def count_signal_conversions_by_group(
+        self,
+        study_id: str,
+        signal: str,
+        start_date,
+        end_date,
+        exposure_only: bool = False,
+        attribution_window_hours: float = None,
+    ) -> dict:
+        """
+        Count the distinct consumers of each study group that sent a given keyword signal.
+
+        The signals are joined with the study groups and counted in the database,
+        so no signal rows are transferred.
+
+        Args:
+            study_id (str): Study ID.
+            signal (str): Name of the keyword signal.
+            start_date (datetime.date): Start date of the study.
+            end_date (datetime.date): End date of the study.
+            exposure_only (bool): Whether or not to only count signals sent after the
+                consumer was assigned to a group. Defaults to False.
+            attribution_window_hours (float): If exposure_only, maximum hours between the
+                assignment and the signal. Defaults to None (until the end of the study).
+
+        Returns:
+            conversions_by_group (dict): Number of signalling consumers for each group name.
+        """
+        start_time = pd.Timestamp(start_date).to_pydatetime()
+        end_time = (pd.Timestamp(end_date) + pd.Timedelta(days=1)).to_pydatetime()
+        params = [study_id, signal, start_time, end_time]
+
+        exposure_filters = ""
+        if exposure_only:
+            # members assigned before assignment times were recorded count from the start
+            exposure_filters = "AND s.created_at >= COALESCE(g.assigned_at, %s)"
+            params.append(start_time)
+            if attribution_window_hours:
+                exposure_filters += """
+                AND s.created_at < COALESCE(g.assigned_at, %s) + INTERVAL %s SECOND"""
+                params.extend([start_time, int(attribution_window_hours * 3600)])
+
+        # signals store the phone number as received by the webhook (digits only)
+        query = f"""
+            SELECT g.group_name, COUNT(DISTINCT g.phone_number) AS conversions
+            FROM lift_studies_groups g
+            JOIN signals s
+                ON s.consumer_phone_number = REGEXP_REPLACE(g.phone_number, '[^0-9]', '')
+            JOIN keywords k ON k.id = s.keyword_id
+            WHERE g.study_id = %s
+            AND k.`signal` = %s
+            AND s.created_at >= %s
+            AND s.created_at < %s
+            {exposure_filters}
+            GROUP BY g.group_name;
+        """
+        result, _ = self.execute_query(query, params=tuple(params))
+
+        return {group_name: int(count) for group_name, count in result}
+
+    def read_table(
+        self,
+        table: str,
+        filters: str = "",
+        columns: list = None,
+        params: tuple = (),
+        batched: bool = False,
+        dtypes: dict = None,
+        as_arrays: bool = False,
+    ):
         """
         Read data from a table in the database.
 
         Args:
             table (str): Table to read from.
-            filters (str): Filters to apply on the table.
+            filters (str): Filters to apply on the table, with %s placeholders for params.
+            columns (list): Columns to read. Defaults to None (all columns).
+            params (tuple): Parameters to be used in the filters. Defaults to an empty tuple.
+            batched (bool): Whether or not to stream the rows with an unbuffered cursor
+                into typed column arrays. Defaults to False.
+            dtypes (dict): In batched mode, NumPy dtype of each column. Defaults to object.
+            as_arrays (bool): Whether or not to return the column arrays instead of a
+                DataFrame. Implies batched mode. Defaults to False.
 
         Returns:
-            result_df (pandas.DataFrame): DataFrame containing the data.
+            result_df (pandas.DataFrame): DataFrame containing the data, or a dict of
+                column name to NumPy array if as_arrays is set.
         """
-        query = f"SELECT * FROM {table}{f' WHERE {filters}' if filters else ''};"
-        result, cursor_cols = self.execute_query(query)
+        select_cols = ", ".join(columns) if columns else "*"
+        query = f"SELECT {select_cols} FROM {table}{f' WHERE {filters}' if filters else ''};"
+
+        if batched or as_arrays:
+            arrays = self.fetch_arrays(query, params, dtypes)
+            return arrays if as_arrays else pd.DataFrame(arrays)
+
+        result, cursor_cols = self.execute_query(query, params=params)
         result_df = pd.DataFrame(result, columns=cursor_cols)
         return result_df
 
-    def get_active_study_id(self) -> str:
+    def list_studies(
+        self,
+        fields: list,
+        status: str = None,
+        from_date=None,
+        to_date=None,
+        after_id: str = None,
+        limit: int = 100,
+    ) -> list:
         """
-        Get the active study.
+        Read a page of studies, ordered by ID.
+
+        Args:
+            fields (list): Columns to read. Dates are formatted as YYYY-MM-DD.
+            status (str): Only read studies with this status. Defaults to None (any).
+            from_date (datetime.date): Only read studies ending on or after this date.
+                Defaults to None.
+            to_date (datetime.date): Only read studies starting on or before this date.
+                Defaults to None.
+            after_id (str): Only read studies with an ID greater than this one, the
+                last ID of the previous page. Defaults to None (first page).
+            limit (int): Maximum number of studies to read. Defaults to 100.
 
         Returns:
-            active_study (str): ID of the active study.
+            studies (list): Dicts with the fields of each study, and its id.
         """
-        query = """
-            SELECT id
+        select_cols = ", ".join(
+            ["id"]
+            + [
+                f"DATE_FORMAT({field}, '%%Y-%%m-%%d') AS {field}"
+                if field in DATE_COLUMNS
+                else field
+                for field in fields
+                if field != "id"
+            ]
+        )
+
+        filters, params = [], []
+        for condition, value in (
+            ("status = %s", status),
+            ("end_date >= %s", from_date),
+            ("start_date <= %s", to_date),
+            ("id > %s", after_id),
+        ):
+            if value is not None:
+                filters.append(condition)
+                params.append(value)
+        where = f"WHERE {' AND '.join(filters)}" if filters else ""
+
+        query = f"SELECT {select_cols} FROM lift_studies {where} ORDER BY id LIMIT %s;"
+        rows, cols = self.execute_query(query, params=(*params, limit))
+
+        return [dict(zip(cols, row)) for row in rows]
+
+    def get_active_studies(self, for_update: bool = False) -> dict:
+        """
+        Get the active studies, by template name.
+
+        Args:
+            for_update (bool): Whether or not to lock the rows read until the end of
+                the current transaction, so concurrent activations wait for it.
+                Defaults to False.
+
+        Returns:
+            active_studies (dict): ID of the active study of each template name.
+        """
+        query = f"""
+            SELECT id, template_names
             FROM lift_studies
             WHERE status='active'
             AND start_date <= CURRENT_DATE
-            AND end_date >= CURRENT_DATE;
+            AND end_date >= CURRENT_DATE
+            ORDER BY start_date, id{" FOR UPDATE" if for_update else ""};
         """
-        active_study, _ = self.execute_query(query)
+        active_studies, _ = self.execute_query(query)
 
-        assert len(active_study) <= 1, "More than one active study found."
+        studies_by_template = {}
+        for study_id, template_names in active_studies:
+            for template_name in (template_names or "").split(","):
+                if not template_name:
+                    continue
+                # keep the earliest study, the creation checks should prevent this
+                if template_name in studies_by_template:
+                    print(
+                        f"Template {template_name} is in active studies "
+                        f"{studies_by_template[template_name]} and {study_id}"
+                    )
+                    continue
+                studies_by_template[template_name] = study_id
 
-        return None if not active_study else active_study[0][0]
+        return studies_by_template
 
-    def upload_new_study(self, info: dict):
+    def get_scheduled_studies(self, for_update: bool = False) -> dict:
+        """
+        Get the studies that are not paused and not over yet.
+
+        Args:
+            for_update (bool): Whether or not to lock the rows read until the end of
+                the current transaction, so concurrent creations and activations wait
+                for it. Defaults to False.
+
+        Returns:
+            scheduled_studies (dict): Start date, end date and list of template names
+                of each study, by study ID.
+        """
+        query = f"""
+            SELECT id, start_date, end_date, template_names
+            FROM lift_studies
+            WHERE status='active'
+            AND end_date >= CURRENT_DATE{" FOR UPDATE" if for_update else ""};
+        """
+        scheduled_studies, _ = self.execute_query(query)
+
+        return {
+            study_id: (
+                start_date,
+                end_date,
+                [name for name in (template_names or "").split(",") if name],
+            )
+            for study_id, start_date, end_date, template_names in scheduled_studies
+        }
+
+    def get_study_metadata(
+        self, study_id: str, for_update: bool = False
+    ) -> StudyMetadata:
+        """
+        Read the row of a study.
+
+        Args:
+            study_id (str): Study ID.
+            for_update (bool): Whether or not to lock the study row until the end of
+                the current transaction. Defaults to False.
+
+        Returns:
+            study (StudyMetadata): Fields of the study, or None if it does not exist.
+        """
+        query = f"""
+            SELECT {", ".join(StudyMetadata.__slots__)}
+            FROM lift_studies
+            WHERE id = %s{" FOR UPDATE" if for_update else ""};
+        """
+        rows, _ = self.execute_query(query, params=(study_id,))
+
+        return StudyMetadata(*rows[0]) if rows else None
+
+    def upload_new_study(self, info: dict, commit: bool = True):
         """
         Upload study information to the database.
 
         Args:
             info (dict): Dictionary containing the study information.
+            commit (bool): Whether or not to commit the insert. Defaults to True, set it
+                to False within a transaction.
         """
         keys = ", ".join(info.keys())
         values_placeholder = ", ".join(["%s"] * len(info))
         query = f"INSERT INTO lift_studies ({keys}) VALUES ({values_placeholder});"
-        _, _ = self.execute_query(query, True, tuple(info.values()))
+        _, _ = self.execute_query(query, commit, tuple(info.values()))
 
-    def update_lift_study_data(self, study_id: str, field: str, value: str):
+    def update_lift_study_data(self, study_id: str, fields: dict, commit: bool = True):
         """
-        Update a field of a study.
+        Update fields of a study in a single statement.
 
         Args:
             study_id (str): Study ID.
-            field (str): Field to update.
-            value (str): Value to set.
+            fields (dict): Values to set, by column name. Column names must be validated
+                by the caller.
+            commit (bool): Whether or not to commit the update. Defaults to True, set it
+                to False within a transaction.
         """
-        query = f"UPDATE lift_studies SET {field}='{value}' WHERE id='{study_id}';"
-        _, _ = self.execute_query(query, True)
+        assignments = ", ".join(f"{field} = %s" for field in fields)
+        query = f"UPDATE lift_studies SET {assignments} WHERE id = %s;"
+        _, _ = self.execute_query(query, commit, (*fields.values(), study_id))
 
-    def exists_study_with_id(self, study_id: str) -> bool:
+    def exists_study_with_id(self, study_id: str, for_update: bool = False) -> bool:
         """
         Check if a study exists in the database.
 
         Args:
             study_id (str): Study ID.
+            for_update (bool): Whether or not to lock the study row until the end of
+                the current transaction. Defaults to False.
 
         Returns:
             exists (bool): Whether or not the study exists.
         """
-        query = f"SELECT EXISTS(SELECT 1 FROM lift_studies WHERE id='{study_id}');"
-        exists, _ = self.execute_query(query)
+        if for_update:
+            query = "SELECT id FROM lift_studies WHERE id = %s FOR UPDATE;"
+            exists, _ = self.execute_query(query, params=(study_id,))
+            return bool(exists)
+
+        query = "SELECT EXISTS(SELECT 1 FROM lift_studies WHERE id = %s);"
+        exists, _ = self.execute_query(query, params=(study_id,))
 
         return bool(int(exists[0][0]))
+
+    def get_study_group_sizes(self, study_id: str, for_update: bool = False):
+        """
+        Get the sample size and current group sizes of a study.
+
+        Args:
+            study_id (str): Study ID.
+            for_update (bool): Whether or not to lock the study row until the end of
+                the current transaction. Defaults to False.
+
+        Returns:
+            sample_size (int): Maximum size of each group.
+            control_group_size (int): Current size of the control group.
+            test_group_size (int): Current size of the test group.
+        """
+        query = f"""
+            SELECT sample_size, control_group_size, test_group_size
+            FROM lift_studies
+            WHERE id = %s{" FOR UPDATE" if for_update else ""};
+        """
+        sizes, _ = self.execute_query(query, params=(study_id,))
+        assert sizes, f"Study {study_id} does not exist."
+
+        return tuple(int(size) for size in sizes[0])
+
+    def get_study_group_counts(self, study_id: str) -> dict:
+        """
+        Count the members of each group of a study.
+
+        Args:
+            study_id (str): Study ID.
+
+        Returns:
+            group_sizes (dict): Number of members for each group name.
+        """
+        query = """
+            SELECT group_name, COUNT(*)
+            FROM lift_studies_groups
+            WHERE study_id = %s
+            GROUP BY group_name;
+        """
+        counts, _ = self.execute_query(query, params=(study_id,))
+
+        return {group_name: int(count) for group_name, count in counts}
+
+    def iter_study_group_batches(self, study_id: str, with_group_name: bool = True):
+        """
+        Stream the members of a study in batches.
+
+        Args:
+            study_id (str): Study ID.
+            with_group_name (bool): Whether or not to read the stored group of each
+                member. Defaults to True.
+
+        Returns:
+            batches (iterator): Dicts with the phone_number (and group_name) arrays of
+                each batch, see iter_batches.
+        """
+        query = f"""
+            SELECT phone_number{", group_name" if with_group_name else ""}
+            FROM lift_studies_groups
+            WHERE study_id = %s;
+        """
+        return self.iter_batches(query, (study_id,))
+
+    def upsert_study_sketch(
+        self,
+        study_id: str,
+        group_name: str,
+        event_name: str,
+        sketch_date,
+        sketch: bytes,
+        commit: bool = True,
+    ):
+        """
+        Store the converters sketch of a study group for an event and day.
+
+        Args:
+            study_id (str): Study ID.
+            group_name (str): Name of the group.
+            event_name (str): Name of the conversion event.
+            sketch_date (datetime.date): Day of the conversions.
+            sketch (bytes): Serialized HyperLogLog sketch.
+            commit (bool): Whether or not to commit the changes. Defaults to True.
+        """
+        query = """
+            REPLACE INTO lift_studies_sketches
+                (study_id, group_name, event_name, sketch_date, sketch)
+            VALUES (%s, %s, %s, %s, %s);
+        """
+        _, _ = self.execute_query(
+            query, commit, (study_id, group_name, event_name, sketch_date, sketch)
+        )
+
+    def get_latest_sketch_date(self, study_id: str, event_name: str):
+        """
+        Get the last day with converters sketches of a study for an event.
+
+        Args:
+            study_id (str): Study ID.
+            event_name (str): Name of the conversion event.
+
+        Returns:
+            sketch_date (datetime.date): Last day with sketches, None if there are none.
+        """
+        query = """
+            SELECT MAX(sketch_date)
+            FROM lift_studies_sketches
+            WHERE study_id = %s
+            AND event_name = %s;
+        """
+        sketch_date, _ = self.execute_query(query, params=(study_id, event_name))
+
+        return sketch_date[0][0]
+
+    def read_study_sketches(
+        self, study_id: str, event_name: str, start_date, end_date
+    ) -> list:
+        """
+        Read the converters sketches of a study for an event within a timeframe.
+
+        Args:
+            study_id (str): Study ID.
+            event_name (str): Name of the conversion event.
+            start_date (datetime.date): First day of the sketches.
+            end_date (datetime.date): Last day of the sketches.
+
+        Returns:
+            sketches (list): (group_name, serialized sketch) pairs, one per group and day.
+        """
+        query = """
+            SELECT group_name, sketch
+            FROM lift_studies_sketches
+            WHERE study_id = %s
+            AND event_name = %s
+            AND sketch_date BETWEEN %s AND %s;
+        """
+        sketches, _ = self.execute_query(
+            query, params=(study_id, event_name, start_date, end_date)
+        )
+
+        return [(group_name, bytes(sketch)) for group_name, sketch in sketches]
+
+    def acquire_results_lease(
+        self, request_key: str, owner: str, lease_seconds: int, ttl_seconds: int
+    ):
+        """
+        Take the lease to compute the results of a request, unless they were stored
+        recently or another request holds an active lease on them. Taking the lease
+        also deletes the expired results of every request.
+
+        Args:
+            request_key (str): Key of the results request.
+            owner (str): ID of the request taking the lease.
+            lease_seconds (int): Duration of the lease.
+            ttl_seconds (int): Time stored results are valid for.
+
+        Returns:
+            state (str): "done" if the results are stored, "running" if another request
+                holds the lease, or "acquired" if the lease was taken.
+            results (str): Stored results in JSON if state is "done", None otherwise.
+        """
+        self.begin_transaction()
+        try:
+            _, _ = self.execute_query(
+                """
+                INSERT IGNORE INTO lift_studies_results (request_key, status)
+                VALUES (%s, 'new');
+                """,
+                params=(request_key,),
+            )
+            # lock the row so only one request can take the lease
+            rows, _ = self.execute_query(
+                """
+                SELECT
+                    status,
+                    results,
+                    lease_expires_at > NOW(),
+                    updated_at > NOW() - INTERVAL %s SECOND
+                FROM lift_studies_results
+                WHERE request_key = %s
+                FOR UPDATE;
+                """,
+                params=(ttl_seconds, request_key),
+            )
+            status, results, lease_active, fresh = rows[0]
+
+            if status == "done" and fresh:
+                self.commit()
+                return "done", results
+            if status == "running" and lease_active:
+                self.commit()
+                return "running", None
+
+            _, _ = self.execute_query(
+                """
+                UPDATE lift_studies_results
+                SET status = 'running',
+                    lease_owner = %s,
+                    lease_expires_at = NOW() + INTERVAL %s SECOND
+                WHERE request_key = %s;
+                """,
+                params=(owner, lease_seconds, request_key),
+            )
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+        self.delete_expired_results(ttl_seconds)
+
+        return "acquired", None
+
+    def delete_expired_results(self, ttl_seconds: int):
+        """
+        Delete the results stored, and the leases released or expired, more than
+        ttl_seconds ago, since they are never reused.
+
+        Args:
+            ttl_seconds (int): Time stored results are valid for.
+        """
+        query = """
+            DELETE FROM lift_studies_results
+            WHERE COALESCE(updated_at, lease_expires_at) < NOW() - INTERVAL %s SECOND
+            AND (lease_expires_at IS NULL OR lease_expires_at < NOW());
+        """
+        _, _ = self.execute_query(query, True, (ttl_seconds,))
+
+    def store_results(self, request_key: str, owner: str, results: str):
+        """
+        Store the results of a request and release its lease.
+
+        Args:
+            request_key (str): Key of the results request.
+            owner (str): ID of the request holding the lease.
+            results (str): Results in JSON.
+        """
+        query = """
+            UPDATE lift_studies_results
+            SET status = 'done', results = %s, updated_at = NOW(), lease_owner = NULL
+            WHERE request_key = %s
+            AND lease_owner = %s;
+        """
+        _, _ = self.execute_query(query, True, (results, request_key, owner))
+
+    def release_results_lease(self, request_key: str, owner: str):
+        """
+        Release the lease of a request whose results could not be computed.
+
+        Args:
+            request_key (str): Key of the results request.
+            owner (str): ID of the request holding the lease.
+        """
+        query = """
+            UPDATE lift_studies_results
+            SET status = 'failed', lease_owner = NULL
+            WHERE request_key = %s
+            AND lease_owner = %s;
+        """
+        _, _ = self.execute_query(query, True, (request_key, owner))
+
+    def insert_study_groups(
+        self,
+        study_id: str,
+        phone_numbers,
+        group_names,
+        batch_size: int = INSERT_BATCH_SIZE,
+    ):
+        """
+        Insert group members of a study in batched multi-row inserts, without committing.
+
+        Members are inserted without an assignment time, unlike the members the
+        router assigns when messaging them, so with exposure attribution they count
+        from the start of the study rather than from the upload.
+
+        Args:
+            study_id (str): Study ID.
+            phone_numbers (numpy.ndarray): Phone numbers of the members.
+            group_names (numpy.ndarray): Group of each member.
+            batch_size (int): Number of rows per insert statement.
+        """
+        query = """
+            INSERT INTO lift_studies_groups
+                (study_id, phone_number, group_name, assigned_at)
+            VALUES (%s, %s, %s, %s)
+        """
+        cursor = self.conn.cursor()
+        try:
+            for start in range(0, len(phone_numbers), batch_size):
+                end = start + batch_size
+                cursor.executemany(
+                    query,
+                    list(
+                        zip(
+                            itertools.repeat(study_id),
+                            phone_numbers[start:end].tolist(),
+                            group_names[start:end].tolist(),
+                            itertools.repeat(None),
+                        )
+                    ),
+                )
+        finally:
+            cursor.close()
+
+    def increment_study_group_sizes(
+        self, study_id: str, control_count: int, test_count: int, commit: bool = False
+    ):
+        """
+        Increment the group sizes of a study.
+
+        Args:
+            study_id (str): Study ID.
+            control_count (int): Number of members added to the control group.
+            test_count (int): Number of members added to the test group.
+            commit (bool): Whether or not to commit the changes. Defaults to False.
+        """
+        query = """
+            UPDATE lift_studies
+            SET control_group_size = control_group_size + %s,
+                test_group_size = test_group_size + %s
+            WHERE id = %s;
+        """
+        _, _ = self.execute_query(
+            query, commit, (int(control_count), int(test_count), study_id)
+        )
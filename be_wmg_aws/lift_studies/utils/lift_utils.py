@@ -3,38 +3,821 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
+import json
+import struct
+import zlib
+
 import numpy as np
 import pandas as pd
-from scipy.stats import chi2_contingency, norm
+from scipy.stats import chi2_contingency, norm, ttest_ind_from_stats
+
+# groups of the hash assignment mode, indexed by the top bit of the phone hash
+HASH_GROUPS = np.array(["control", "test"], dtype=object)
+# splitmix64 constants, the router implements the same hash
+SPLITMIX64_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+SPLITMIX64_MUL_1 = np.uint64(0xBF58476D1CE4E5B9)
+SPLITMIX64_MUL_2 = np.uint64(0x94D049BB133111EB)
+# prime modulus and multiplier of the phone sample hash, small enough to compute
+# the same hash in MySQL without overflows
+PHONE_SAMPLE_MODULUS = 1000003
+PHONE_SAMPLE_MULTIPLIER = 694847
+# header of serialized StudyMembership objects
+MEMBERSHIP_MAGIC = b"LSM1"
+# header of serialized HyperLogLog sketches
+SKETCH_MAGIC = b"HLL1"
+# number of index bits of the HyperLogLog sketches, 2^14 registers (0.8% error)
+SKETCH_PRECISION = 14
+
+
+def get_conversions_in_window(conversions, start_date, end_date, conversion_event_name):
+    """
+    Get the conversions of a given event within the study's timeframe.
+
+    Args:
+        conversions (pandas.DataFrame): DataFrame containing all conversions.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        conversion_event_name (str): Name of the conversion event.
+
+    Returns:
+        conversions (pandas.DataFrame): DataFrame containing the conversions in the window.
+    """
+    return conversions[
+        conversions["event_time"].dt.date.ge(pd.Timestamp(start_date).date())
+        & conversions["event_time"].dt.date.le(pd.Timestamp(end_date).date())
+        & conversions["event_name"].eq(conversion_event_name)
+    ]
+
+
+def filter_conversions(
+    conversions, start_date, end_date, conversion_event_name, study_groups
+):
+    """
+    Filter conversions to only include those that are relevant to the study.
+
+    Args:
+        conversions (pandas.DataFrame): DataFrame containing all conversions.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        conversion_event_name (str): Name of the conversion event.
+        study_groups (pandas.DataFrame): DataFrame containing the study groups.
+
+    Returns:
+        valid_conversions (pandas.DataFrame): DataFrame containing all valid conversions
+    """
+    # conversions within the study's timeframe and conversion event
+    valid_conversions = get_conversions_in_window(
+        conversions, start_date, end_date, conversion_event_name
+    )
+
+    # conversions where the customer is part of one of the study's groups
+    valid_conversions = valid_conversions.merge(
+        study_groups, left_on="user_phone", right_on="phone_number", how="inner"
+    )
+
+    # remove duplicates - some customers may have multiple conversions
+    valid_conversions = valid_conversions[["user_phone", "group_name"]].drop_duplicates(
+        ignore_index=True
+    )
+
+    return valid_conversions
+
+
+def filter_conversions_with_pre_period(
+    conversions,
+    start_date,
+    end_date,
+    pre_period_days,
+    conversion_event_name,
+    study_groups,
+):
+    """
+    Flag the study's members that converted during the study and during the days before it.
+
+    Args:
+        conversions (pandas.DataFrame): DataFrame containing all conversions.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        pre_period_days (int): Number of days before the study in the pre-period.
+        conversion_event_name (str): Name of the conversion event.
+        study_groups (pandas.DataFrame): DataFrame containing the study groups.
+
+    Returns:
+        conversion_flags (pandas.DataFrame): One row per member with conversions in
+            either period, with boolean in_study and pre_period columns.
+    """
+    pre_start_date = pd.Timestamp(start_date) - pd.Timedelta(days=pre_period_days)
+
+    # conversions within the pre-period or the study's timeframe, in a single pass
+    valid_conversions = get_conversions_in_window(
+        conversions, pre_start_date, end_date, conversion_event_name
+    )
+    valid_conversions = valid_conversions.merge(
+        study_groups, left_on="user_phone", right_on="phone_number", how="inner"
+    )
+
+    in_study = valid_conversions["event_time"].dt.date.ge(
+        pd.Timestamp(start_date).date()
+    )
+    conversion_flags = (
+        pd.DataFrame(
+            {
+                "user_phone": valid_conversions["user_phone"],
+                "group_name": valid_conversions["group_name"],
+                "in_study": in_study,
+                "pre_period": ~in_study,
+            }
+        )
+        .groupby(["user_phone", "group_name"], as_index=False)
+        .any()
+    )
+
+    return conversion_flags
+
+
+def normalize_phone_numbers(phone_numbers):
+    """
+    Normalize phone numbers to digits only and remove empty and duplicated ones.
+
+    Args:
+        phone_numbers (pandas.Series): Phone numbers, in any format.
+
+    Returns:
+        phone_numbers (numpy.ndarray): Unique normalized phone numbers, in order of first appearance.
+    """
+    phone_numbers = (
+        pd.Series(phone_numbers, dtype=object)
+        .astype(str)
+        .str.replace(r"[^0-9]", "", regex=True)
+    )
+
+    return pd.unique(phone_numbers[phone_numbers.str.len() > 0].to_numpy())
+
+
+def split_audience(phone_numbers, control_capacity, test_capacity, seed=None):
+    """
+    Randomly split an audience into balanced control and test groups.
+
+    The audience is shuffled with a seeded generator and split as evenly as the
+    remaining capacity of each group allows. Phones that do not fit in either
+    group are left out.
+
+    Args:
+        phone_numbers (numpy.ndarray): Unique phone numbers of the audience.
+        control_capacity (int): Number of members the control group can still take.
+        test_capacity (int): Number of members the test group can still take.
+        seed (int): Seed of the random generator. Defaults to None (random seed).
+
+    Returns:
+        phone_numbers (numpy.ndarray): Phone numbers of the assigned members.
+        group_names (numpy.ndarray): Group of each assigned member.
+    """
+    control_capacity = max(control_capacity, 0)
+    test_capacity = max(test_capacity, 0)
+    num_assigned = min(len(phone_numbers), control_capacity + test_capacity)
+
+    # half of the members in each group, unless one of them runs out of capacity
+    num_control = min(
+        control_capacity, max(num_assigned - test_capacity, num_assigned // 2)
+    )
+    num_test = num_assigned - num_control
+
+    shuffled = np.random.default_rng(seed).permutation(phone_numbers)[:num_assigned]
+    group_names = np.repeat(
+        np.array(["control", "test"], dtype=object), [num_control, num_test]
+    )
+
+    return shuffled, group_names
+
+
+def split_audience_into_arms(phone_numbers, capacities, seed=None):
+    """
+    Randomly split an audience into the groups of a multi-arm study.
+
+    The audience is shuffled with a seeded generator and split as evenly as the
+    remaining capacity of each group allows. Phones that do not fit in any group
+    are left out.
+
+    Args:
+        phone_numbers (numpy.ndarray): Unique phone numbers of the audience.
+        capacities (dict): Number of members each group can still take.
+        seed (int): Seed of the random generator. Defaults to None (random seed).
+
+    Returns:
+        phone_numbers (numpy.ndarray): Phone numbers of the assigned members.
+        group_names (numpy.ndarray): Group of each assigned member.
+    """
+    capacities = {name: max(capacity, 0) for name, capacity in capacities.items()}
+    num_remaining = min(len(phone_numbers), sum(capacities.values()))
+
+    # fill the groups with the least capacity first, so the rest can take their share
+    sizes = {}
+    by_capacity = sorted(capacities, key=capacities.get)
+    for i, group_name in enumerate(by_capacity):
+        share = -(-num_remaining // (len(by_capacity) - i))
+        sizes[group_name] = min(capacities[group_name], share)
+        num_remaining -= sizes[group_name]
+
+    num_assigned = sum(sizes.values())
+    shuffled = np.random.default_rng(seed).permutation(phone_numbers)[:num_assigned]
+    group_names = np.repeat(
+        np.array(list(capacities), dtype=object),
+        [sizes[group_name] for group_name in capacities],
+    )
+
+    return shuffled, group_names
+
+
+def get_phone_keys(phone_numbers):
+    """
+    Convert normalized (digits only) phone numbers to int64 keys.
+
+    Args:
+        phone_numbers (pandas.Series): Phone numbers with digits only.
+
+    Returns:
+        keys (numpy.ndarray): int64 key for each phone number, -1 when it is not valid.
+    """
+    phone_numbers = pd.Series(phone_numbers, dtype=object).astype(str)
+    valid = phone_numbers.str.fullmatch(r"[0-9]{1,18}").to_numpy(dtype=bool)
+
+    keys = np.full(len(phone_numbers), -1, dtype=np.int64)
+    keys[valid] = phone_numbers[valid].astype(np.int64).to_numpy()
+
+    return keys
+
+
+def get_assignment_key(study_id: str, salt: str) -> np.uint64:
+    """
+    Get the 64-bit key of the hash assignment of a study.
+
+    Args:
+        study_id (str): ID of the study.
+        salt (str): Assignment salt of the study.
+
+    Returns:
+        key (numpy.uint64): First 8 bytes (little endian) of sha256("study_id:salt").
+    """
+    digest = hashlib.sha256(f"{study_id}:{salt}".encode()).digest()
+
+    return np.uint64(int.from_bytes(digest[:8], "little"))
+
+
+def hash_phone_keys(phone_keys, key):
+    """
+    Hash int64 phone keys with a keyed splitmix64 finalizer.
+
+    Args:
+        phone_keys (numpy.ndarray): int64 phone keys, as returned by get_phone_keys.
+        key (numpy.uint64): Assignment key of the study.
+
+    Returns:
+        hashes (numpy.ndarray): uint64 hash of each phone key.
+    """
+    z = (
+        np.asarray(phone_keys, dtype=np.int64).view(np.uint64) ^ key
+    ) + SPLITMIX64_GAMMA
+    z = (z ^ (z >> np.uint64(30))) * SPLITMIX64_MUL_1
+    z = (z ^ (z >> np.uint64(27))) * SPLITMIX64_MUL_2
+
+    return z ^ (z >> np.uint64(31))
+
+
+def assign_groups_by_hash(phone_numbers, study_id: str, salt: str):
+    """
+    Get the groups of the members of a study in the hash assignment mode.
+
+    Args:
+        phone_numbers (pandas.Series): Phone numbers with digits only.
+        study_id (str): ID of the study.
+        salt (str): Assignment salt of the study.
+
+    Returns:
+        group_names (numpy.ndarray): Group of each phone number, None when it is not valid.
+    """
+    phone_keys = get_phone_keys(phone_numbers)
+    hashes = hash_phone_keys(phone_keys, get_assignment_key(study_id, salt))
+
+    group_names = HASH_GROUPS[(hashes >> np.uint64(63)).astype(np.intp)]
+    group_names[phone_keys < 0] = None
+
+    return group_names
+
+
+def split_audience_by_hash(
+    phone_numbers, study_id: str, salt: str, control_capacity, test_capacity
+):
+    """
+    Split an audience into the groups given by the hash assignment of a study.
+
+    Phones whose group is already full are left out, as the router does.
+
+    Args:
+        phone_numbers (numpy.ndarray): Unique phone numbers of the audience.
+        study_id (str): ID of the study.
+        salt (str): Assignment salt of the study.
+        control_capacity (int): Number of members the control group can still take.
+        test_capacity (int): Number of members the test group can still take.
+
+    Returns:
+        phone_numbers (numpy.ndarray): Phone numbers of the assigned members.
+        group_names (numpy.ndarray): Group of each assigned member.
+    """
+    group_names = assign_groups_by_hash(phone_numbers, study_id, salt)
+
+    keep = np.zeros(len(phone_numbers), dtype=bool)
+    for group_name, capacity in (
+        ("control", control_capacity),
+        ("test", test_capacity),
+    ):
+        keep[np.flatnonzero(group_names == group_name)[: max(capacity, 0)]] = True
+
+    return np.asarray(phone_numbers)[keep], group_names[keep]
+
+
+class StudyMembership:
+    """
+    Members of each group of a study, as sorted arrays of unique int64 phone keys.
+
+    Takes 8 bytes per member, and serializes to a few bytes per member by
+    compressing the gaps between consecutive keys.
+    """
+
+    __slots__ = ("keys",)
+
+    def __init__(self, keys: dict):
+        """
+        Args:
+            keys (dict): Sorted unique int64 phone keys of each group name.
+        """
+        self.keys = keys
+
+    @classmethod
+    def from_batches(cls, batches):
+        """
+        Build the membership from batches of the lift_studies_groups table.
+
+        Args:
+            batches (iterable): Dicts with phone_number and group_name arrays.
+
+        Returns:
+            membership (StudyMembership): Members of each group.
+        """
+        keys = {}
+        for batch in batches:
+            phone_keys = get_phone_keys(
+                pd.Series(batch["phone_number"], dtype=object)
+                .astype(str)
+                .str.replace(r"[^0-9]", "", regex=True)
+            )
+            codes, groups = pd.factorize(batch["group_name"])
+            for i, group_name in enumerate(groups):
+                group_keys = phone_keys[(codes == i) & (phone_keys >= 0)]
+                keys.setdefault(group_name, []).append(group_keys)
+
+        return cls(
+            {group_name: np.unique(np.concatenate(k)) for group_name, k in keys.items()}
+        )
+
+    def sample(self, sample_fraction: float):
+        """
+        Keep only the members in a consistent sample of the phone keys.
+
+        Args:
+            sample_fraction (float): Fraction of the phone keys in the sample.
+
+        Returns:
+            membership (StudyMembership): Members of each group in the sample.
+        """
+        return StudyMembership(
+            {
+                group_name: group_keys[in_phone_sample(group_keys, sample_fraction)]
+                for group_name, group_keys in self.keys.items()
+            }
+        )
+
+    def count(self) -> dict:
+        """
+        Count the members of each group.
+
+        Returns:
+            group_sizes (dict): Number of members for each group name.
+        """
+        return {
+            group_name: len(group_keys) for group_name, group_keys in self.keys.items()
+        }
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory taken by the phone keys, in bytes.
+        """
+        return sum(group_keys.nbytes for group_keys in self.keys.values())
+
+    def intersect(self, phone_keys) -> dict:
+        """
+        Get the members of each group among a set of phone keys.
+
+        Args:
+            phone_keys (numpy.ndarray): int64 phone keys, possibly repeated.
+
+        Returns:
+            members (dict): Sorted unique phone keys of the members of each group.
+        """
+        phone_keys = np.unique(phone_keys)
+
+        members = {}
+        for group_name, group_keys in self.keys.items():
+            if len(group_keys) == 0:
+                members[group_name] = group_keys
+                continue
+            # binary search of every key in the sorted members of the group
+            idx = np.searchsorted(group_keys, phone_keys).clip(max=len(group_keys) - 1)
+            members[group_name] = phone_keys[group_keys[idx] == phone_keys]
+
+        return members
+
+    def count_members(self, phone_keys) -> dict:
+        """
+        Count the members of each group among a set of phone keys.
+
+        Args:
+            phone_keys (numpy.ndarray): int64 phone keys, possibly repeated.
+
+        Returns:
+            counts (dict): Number of distinct members for each group name.
+        """
+        return {
+            group_name: len(members)
+            for group_name, members in self.intersect(phone_keys).items()
+        }
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the membership.
+
+        Returns:
+            data (bytes): Magic, header length, JSON header with the group names and
+                sizes, and the zlib compressed gaps between consecutive keys.
+        """
+        header = json.dumps(
+            {name: len(group_keys) for name, group_keys in self.keys.items()}
+        ).encode()
+        gaps = [np.diff(group_keys, prepend=0) for group_keys in self.keys.values()]
+        body = np.concatenate(gaps or [np.empty(0, dtype=np.int64)]).astype("<i8")
+
+        return (
+            MEMBERSHIP_MAGIC
+            + struct.pack("<I", len(header))
+            + header
+            + zlib.compress(body.tobytes())
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Deserialize a membership serialized with to_bytes.
+
+        Args:
+            data (bytes): Serialized membership.
+
+        Returns:
+            membership (StudyMembership): Members of each group.
+        """
+        assert data[:4] == MEMBERSHIP_MAGIC, "Not a serialized study membership."
+        (header_len,) = struct.unpack("<I", data[4:8])
+        sizes = json.loads(data[8 : 8 + header_len])
+        body = np.frombuffer(zlib.decompress(data[8 + header_len :]), dtype="<i8")
+
+        keys = {}
+        offset = 0
+        for group_name, size in sizes.items():
+            keys[group_name] = np.cumsum(body[offset : offset + size], dtype=np.int64)
+            offset += size
+
+        return cls(keys)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch of a set of phone keys, to estimate its number of distinct
+    keys. Sketches of the same precision are merged by taking the maximum of each
+    register.
+    """
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int = SKETCH_PRECISION, registers=None):
+        """
+        Args:
+            precision (int): Number of index bits, the sketch has 2^precision registers.
+            registers (numpy.ndarray): uint8 registers. Defaults to None (empty sketch).
+        """
+        self.precision = precision
+        self.registers = (
+            np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+        )
+
+    @property
+    def relative_error(self) -> float:
+        """
+        Relative standard error of the estimates of the sketch.
+        """
+        return 1.04 / np.sqrt(len(self.registers))
+
+    def add(self, phone_keys):
+        """
+        Add phone keys to the sketch.
+
+        Args:
+            phone_keys (numpy.ndarray): int64 phone keys.
+
+        Returns:
+            sketch (HyperLogLog): The sketch itself.
+        """
+        hashes = hash_phone_keys(phone_keys, np.uint64(0))
+        num_bits = 64 - self.precision
+
+        idx = (hashes >> np.uint64(num_bits)).astype(np.intp)
+        rest = hashes & np.uint64((1 << num_bits) - 1)
+        # position of the leftmost 1 bit in the remaining bits
+        rank = (num_bits + 1 - _bit_length(rest)).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+        return self
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one.
+
+        Args:
+            other (HyperLogLog): Sketch of the same precision.
+
+        Returns:
+            sketch (HyperLogLog): The sketch itself.
+        """
+        assert other.precision == self.precision, "Sketch precisions do not match."
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+        return self
+
+    def count(self) -> float:
+        """
+        Estimate the number of distinct keys added to the sketch.
+
+        Returns:
+            float: Estimated number of distinct keys.
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+
+        # linear counting is more accurate for small cardinalities
+        num_zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and num_zeros > 0:
+            estimate = m * np.log(m / num_zeros)
+
+        return float(estimate)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the sketch.
+
+        Returns:
+            data (bytes): Magic, precision and zlib compressed registers.
+        """
+        return (
+            SKETCH_MAGIC
+            + bytes([self.precision])
+            + zlib.compress(self.registers.tobytes())
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Deserialize a sketch serialized with to_bytes.
+
+        Args:
+            data (bytes): Serialized sketch.
+
+        Returns:
+            sketch (HyperLogLog): The sketch.
+        """
+        assert data[:4] == SKETCH_MAGIC, "Not a serialized HyperLogLog sketch."
+        registers = np.frombuffer(zlib.decompress(data[5:]), dtype=np.uint8).copy()
+
+        return cls(data[4], registers)
+
+
+def _bit_length(values):
+    """
+    Get the number of bits needed to represent each uint64 value.
+
+    Args:
+        values (numpy.ndarray): uint64 values.
+
+    Returns:
+        bit_lengths (numpy.ndarray): Bit length of each value, 0 for 0.
+    """
+    bit_lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        bit_lengths[high] += shift
+        values = np.where(high, values >> np.uint64(shift), values)
+
+    return bit_lengths + (values > 0)
+
+
+def merge_sketches_by_group(sketches):
+    """
+    Merge the sketches of each group and estimate their distinct converters.
+
+    Args:
+        sketches (iterable): (group_name, serialized sketch) pairs.
+
+    Returns:
+        conversions_by_group (dict): Estimated number of conversions for each group name.
+        relative_error (float): Relative standard error of the estimates.
+    """
+    merged = {}
+    for group_name, data in sketches:
+        sketch = HyperLogLog.from_bytes(data)
+        if group_name in merged:
+            merged[group_name].merge(sketch)
+        else:
+            merged[group_name] = sketch
+
+    conversions_by_group = {
+        group_name: int(round(sketch.count())) for group_name, sketch in merged.items()
+    }
+    relative_error = float(
+        max((sketch.relative_error for sketch in merged.values()), default=0.0)
+    )
+
+    return conversions_by_group, relative_error
+
+
+def build_daily_sketches(conversions, membership):
+    """
+    Build the sketches of the members of each group who converted on each day.
+
+    Args:
+        conversions (pandas.DataFrame): DataFrame containing the conversions of an event.
+        membership (StudyMembership): Members of each group of the study.
+
+    Returns:
+        sketches (dict): HyperLogLog sketch for each (day, group name) pair.
+    """
+    phone_keys = get_phone_keys(conversions["user_phone"])
+    days = conversions["event_time"].dt.date.to_numpy()
+
+    sketches = {}
+    for day, idx in pd.Series(days).groupby(days).indices.items():
+        for group_name, members in membership.intersect(phone_keys[idx]).items():
+            sketches[(day, group_name)] = HyperLogLog().add(members)
+
+    return sketches
+
+
+def count_member_conversions(
+    conversions, start_date, end_date, conversion_event_name, membership
+):
+    """
+    Count the members of each group with a conversion within the study's timeframe.
+
+    Args:
+        conversions (pandas.DataFrame): DataFrame containing all conversions.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        conversion_event_name (str): Name of the conversion event.
+        membership (StudyMembership): Members of each group of the study.
+
+    Returns:
+        conversions_by_group (dict): Number of conversions for each group name.
+    """
+    valid_conversions = get_conversions_in_window(
+        conversions, start_date, end_date, conversion_event_name
+    )
+
+    return membership.count_members(get_phone_keys(valid_conversions["user_phone"]))
+
+
+def get_phone_sample_threshold(sample_fraction: float) -> int:
+    """
+    Get the bucket threshold of a phone sample.
+
+    Args:
+        sample_fraction (float): Fraction of the phone keys in the sample.
+
+    Returns:
+        int: Phone keys with a sample bucket below it are in the sample.
+    """
+    return int(round(sample_fraction * PHONE_SAMPLE_MODULUS))
+
+
+def in_phone_sample(phone_keys, sample_fraction: float):
+    """
+    Check which phone keys are in a consistent sample of the given fraction.
+
+    The sample bucket of a key is ((key mod M) * A) mod M, with M and A the
+    PHONE_SAMPLE_MODULUS and PHONE_SAMPLE_MULTIPLIER, so the events table can
+    be sampled in the same way in SQL.
+
+    Args:
+        phone_keys (numpy.ndarray): int64 phone keys, as returned by get_phone_keys.
+        sample_fraction (float): Fraction of the phone keys in the sample.
+
+    Returns:
+        in_sample (numpy.ndarray): Whether or not each key is in the sample.
+    """
+    phone_keys = np.asarray(phone_keys, dtype=np.int64)
+    buckets = (
+        (phone_keys % PHONE_SAMPLE_MODULUS) * PHONE_SAMPLE_MULTIPLIER
+    ) % PHONE_SAMPLE_MODULUS
+
+    return (phone_keys >= 0) & (buckets < get_phone_sample_threshold(sample_fraction))
+
+
+def to_utc_naive(times):
+    """
+    Convert timestamps to naive UTC datetime64[ns] values.
+
+    Args:
+        times (pandas.Series): Timestamps, timezone aware or naive (assumed UTC).
+
+    Returns:
+        times (pandas.Series): Naive UTC timestamps.
+    """
+    times = pd.to_datetime(times)
+    if times.dt.tz is not None:
+        times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+
+    return times.astype("datetime64[ns]")
 
 
-def filter_conversions(
-    conversions, start_date, end_date, conversion_event_name, study_groups
+def filter_exposed_conversions(
+    conversions,
+    start_date,
+    end_date,
+    conversion_event_name,
+    study_groups,
+    attribution_window=None,
 ):
     """
-    Filter conversions to only include those that are relevant to the study.
+    Filter conversions to only include those that happened after the customer was
+    assigned to one of the study's groups.
+
+    Conversions are matched to group assignments with a sorted as-of join on the
+    int64 phone key, so each conversion is only compared with the latest assignment
+    of the same phone that happened before it.
 
     Args:
         conversions (pandas.DataFrame): DataFrame containing all conversions.
         start_date (datetime.date): Start date of the study.
         end_date (datetime.date): End date of the study.
         conversion_event_name (str): Name of the conversion event.
-        study_groups (pandas.DataFrame): DataFrame containing the study groups.
+        study_groups (pandas.DataFrame): DataFrame containing the study groups, with
+            the assignment time of each member in the assigned_at column.
+        attribution_window (pandas.Timedelta): Maximum time between assignment and
+            conversion. Defaults to None (until the end of the study).
 
     Returns:
         valid_conversions (pandas.DataFrame): DataFrame containing all valid conversions
     """
-    # conversions within the study's timeframe and conversion event
-    valid_conversions = conversions[
-        conversions["event_time"].dt.date.ge(pd.Timestamp(start_date).date())
-        & conversions["event_time"].dt.date.le(pd.Timestamp(end_date).date())
-        & conversions["event_name"].eq(conversion_event_name)
-    ]
+    valid_conversions = get_conversions_in_window(
+        conversions, start_date, end_date, conversion_event_name
+    )
 
-    # conversions where the customer is part of one of the study's groups
-    valid_conversions = valid_conversions.merge(
-        study_groups, left_on="user_phone", right_on="phone_number", how="inner"
+    events = pd.DataFrame(
+        {
+            "phone_key": get_phone_keys(valid_conversions["user_phone"]),
+            "event_time": to_utc_naive(valid_conversions["event_time"]).to_numpy(),
+            "user_phone": valid_conversions["user_phone"].to_numpy(),
+        }
     )
+    # members assigned before assignment times were recorded count from the start
+    members = pd.DataFrame(
+        {
+            "phone_key": get_phone_keys(study_groups["phone_number"]),
+            "assigned_at": to_utc_naive(study_groups["assigned_at"])
+            .fillna(pd.Timestamp(start_date))
+            .to_numpy(),
+            "group_name": study_groups["group_name"].to_numpy(),
+        }
+    )
+    events = events[events["phone_key"] >= 0].sort_values("event_time")
+    members = members[members["phone_key"] >= 0].sort_values("assigned_at")
+
+    valid_conversions = pd.merge_asof(
+        events,
+        members,
+        left_on="event_time",
+        right_on="assigned_at",
+        by="phone_key",
+        direction="backward",
+        tolerance=attribution_window,
+    ).dropna(subset=["group_name"])
 
     # remove duplicates - some customers may have multiple conversions
     valid_conversions = valid_conversions[["user_phone", "group_name"]].drop_duplicates(
@@ -44,13 +827,17 @@ def filter_conversions(
     return valid_conversions
 
 
-def get_confidence_interval(count, nobs, alpha: float = 0.05):
+def get_confidence_interval(
+    count, nobs, alpha: float = 0.05, relative_error: float = 0.0
+):
     """
     Get confidence interval for a normal distribution.
 
     Args:
         count (float): Count of conversions.
         nobs (int): Number of observations.
+        relative_error (float): Relative standard error of the count, when it is
+            an estimate. Defaults to 0 (exact count).
 
     Returns:
         ci_low (float): Lower bound of the confidence interval.
@@ -58,7 +845,7 @@ def get_confidence_interval(count, nobs, alpha: float = 0.05):
     """
     prop = count / nobs
 
-    std = np.sqrt(prop * (1 - prop) / nobs)
+    std = np.sqrt(prop * (1 - prop) / nobs + (relative_error * prop) ** 2)
     dist = norm.isf(alpha / 2.0) * std
 
     ci_low = prop - dist
@@ -89,12 +876,31 @@ def get_conversion_results_for_group(valid_conversions, group_name, group_size):
     num_conversions = valid_conversions[
         valid_conversions["group_name"] == group_name
     ].shape[0]
+
+    return get_results_for_group(num_conversions, group_size)
+
+
+def get_results_for_group(num_conversions, group_size, relative_error: float = 0.0):
+    """
+    Get results for a study group from its number of conversions.
+
+    Args:
+        num_conversions (int): Number of conversions in the group.
+        group_size (int): Number of customers in the group.
+        relative_error (float): Relative standard error of num_conversions, when it
+            is an estimate. Defaults to 0 (exact count).
+
+    Returns:
+        dict: Results for the group, see get_conversion_results_for_group.
+    """
     # conversion rate
     conversion_rate = num_conversions / group_size if group_size > 0 else 0
     # confidence interval for the conversion rate
     conversion_rate_ci = [
         round(value, 4)
-        for value in get_confidence_interval(num_conversions, group_size)
+        for value in get_confidence_interval(
+            num_conversions, group_size, relative_error=relative_error
+        )
     ]
 
     return {
@@ -186,6 +992,51 @@ def get_study_stats(valid_conversions, control_group_size, test_group_size):
         control_group_size (int): Size of the control group.
         test_group_size (int): Size of the test group.
 
+    Returns:
+        control_results (dict): Results for the control group.
+        test_results (dict): Results for the test group.
+        lift_perc (float): Lift percentage.
+        p_value (float): P-value for the difference between conversion rates.
+    """
+    conversions_by_group = count_conversions_by_group(valid_conversions)
+
+    return get_study_stats_from_counts(
+        conversions_by_group, control_group_size, test_group_size
+    )
+
+
+def count_conversions_by_group(valid_conversions):
+    """
+    Count the valid conversions of each study group.
+
+    Args:
+        valid_conversions (pandas.DataFrame): DataFrame containing all valid conversions.
+
+    Returns:
+        conversions_by_group (dict): Number of conversions for each group name.
+    """
+    return {
+        group_name: int(count)
+        for group_name, count in valid_conversions["group_name"].value_counts().items()
+    }
+
+
+def get_study_stats_from_counts(
+    conversions_by_group,
+    control_group_size,
+    test_group_size,
+    relative_error: float = 0.0,
+):
+    """
+    Get metrics for a given study from the number of conversions of each group.
+
+    Args:
+        conversions_by_group (dict): Number of conversions for each group name.
+        control_group_size (int): Size of the control group.
+        test_group_size (int): Size of the test group.
+        relative_error (float): Relative standard error of the conversion counts, when
+            they are estimates. Defaults to 0 (exact counts).
+
     Returns:
         control_results (dict): Results for the control group.
         test_results (dict): Results for the test group.
@@ -193,11 +1044,11 @@ def get_study_stats(valid_conversions, control_group_size, test_group_size):
         p_value (float): P-value for the difference between conversion rates.
     """
     # calculate statistical results for each group
-    control_results = get_conversion_results_for_group(
-        valid_conversions, "control", control_group_size
+    control_results = get_results_for_group(
+        conversions_by_group.get("control", 0), control_group_size, relative_error
     )
-    test_results = get_conversion_results_for_group(
-        valid_conversions, "test", test_group_size
+    test_results = get_results_for_group(
+        conversions_by_group.get("test", 0), test_group_size, relative_error
     )
 
     # calculate p-value for the difference between conversion rates
@@ -214,3 +1065,540 @@ def get_study_stats(valid_conversions, control_group_size, test_group_size):
     )
 
     return control_results, test_results, lift_perc, p_value
+
+
+def build_study_results(study, conversions_by_group, relative_error: float = 0.0):
+    """
+    Build the results payload for a given study.
+
+    Args:
+        study (dict): Study information, as stored in the lift_studies table.
+        conversions_by_group (dict): Number of conversions for each group name.
+        relative_error (float): Relative standard error of the conversion counts, when
+            they are estimates. Defaults to 0 (exact counts).
+
+    Returns:
+        results (dict): Results for the study.
+    """
+    control_group_size = study["control_group_size"]
+    test_group_size = study["test_group_size"]
+
+    (control_results, test_results, lift_perc, p_value) = get_study_stats_from_counts(
+        conversions_by_group, control_group_size, test_group_size, relative_error
+    )
+
+    # calculate cost per incremental conversion
+    incremental_conversions = (
+        test_results["conversions"] - control_results["conversions"]
+    )
+    cost_per_incremental_conv = calculate_cost_per_incremental_conversion(
+        study["avg_message_cost"], study["messages_count"], incremental_conversions
+    )
+
+    return {
+        "name": study["name"],
+        "start_date": study["start_date"].strftime("%Y-%m-%d"),
+        "end_date": study["end_date"].strftime("%Y-%m-%d"),
+        "sample_size": str(study["sample_size"]),
+        "test_num_conversions": str(test_results["conversions"]),
+        "test_group_size": str(test_group_size),
+        "test_conversion_rate": str(round(test_results["conversion_rate"], 4)),
+        "test_conversion_rate_confidence_interval": str(
+            test_results["confidence_interval"]
+        ),
+        "control_num_conversions": str(control_results["conversions"]),
+        "control_group_size": str(control_group_size),
+        "control_conversion_rate": str(round(control_results["conversion_rate"], 4)),
+        "control_conversion_rate_confidence_interval": str(
+            control_results["confidence_interval"]
+        ),
+        "lift": str(round(lift_perc, 4)),
+        "cost_per_incremental_conversion": str(round(cost_per_incremental_conv, 2)),
+        "p_value": str(round(p_value, 4)),
+    }
+
+
+def adjust_p_values(p_values):
+    """
+    Adjust p-values for multiple comparisons with the Holm-Bonferroni method.
+
+    Args:
+        p_values (list): Raw p-values, NaN for comparisons that could not be made.
+
+    Returns:
+        adjusted_p_values (numpy.ndarray): Adjusted p-values, NaN where the raw p-value is NaN.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(len(p_values), np.nan)
+
+    tested = np.flatnonzero(~np.isnan(p_values))
+    order = tested[np.argsort(p_values[tested])]
+    multipliers = len(order) - np.arange(len(order))
+    adjusted[order] = np.minimum(
+        np.maximum.accumulate(p_values[order] * multipliers), 1.0
+    )
+
+    return adjusted
+
+
+def calculate_omnibus_p_value(observed):
+    """
+    Calculate the p-value of a chi-square test of independence between the groups
+    and conversion.
+
+    Args:
+        observed (numpy.ndarray): k x 2 table with the conversions and non conversions
+            of each group.
+
+    Returns:
+        float: P-value, NaN if the test can not be made.
+    """
+    # the test needs at least two groups and both conversions and non conversions
+    observed = observed[observed.sum(axis=1) > 0]
+    if len(observed) < 2 or (observed.sum(axis=0) == 0).any():
+        return np.nan
+
+    return chi2_contingency(observed, correction=False).pvalue
+
+
+def get_multi_arm_stats(conversions_by_group, group_sizes, control_group="control"):
+    """
+    Get metrics of every arm of a multi-arm study against its control group.
+
+    The conversions and non conversions of all the groups are laid out in a single
+    k x 2 table, used both for the omnibus test and for the pairwise tests of each
+    arm against the control group, adjusted for multiple comparisons.
+
+    Args:
+        conversions_by_group (dict): Number of conversions for each group name.
+        group_sizes (dict): Size of each group.
+        control_group (str): Name of the control group. Defaults to "control".
+
+    Returns:
+        control_results (dict): Results for the control group.
+        arms_results (dict): Results, lift, p-value and adjusted p-value of each arm.
+        omnibus_p_value (float): P-value for any difference between the groups.
+    """
+    group_names = [control_group] + sorted(
+        name for name in group_sizes if name != control_group
+    )
+    sizes = np.array([group_sizes.get(name, 0) for name in group_names])
+    conversions = np.array([conversions_by_group.get(name, 0) for name in group_names])
+    observed = np.column_stack([conversions, sizes - conversions])
+
+    omnibus_p_value = calculate_omnibus_p_value(observed)
+
+    control_results = get_results_for_group(int(conversions[0]), int(sizes[0]))
+    arms_results = {}
+    for i, arm_name in enumerate(group_names[1:], start=1):
+        results = get_results_for_group(int(conversions[i]), int(sizes[i]))
+        arms_results[arm_name] = {
+            "results": results,
+            "lift": calculate_lift(
+                results["conversion_rate"], control_results["conversion_rate"]
+            ),
+            "p_value": calculate_p_value(
+                conversions[0], sizes[0], conversions[i], sizes[i]
+            ),
+        }
+
+    adjusted_p_values = adjust_p_values(
+        [arm["p_value"] for arm in arms_results.values()]
+    )
+    for arm, adjusted_p_value in zip(arms_results.values(), adjusted_p_values):
+        arm["adjusted_p_value"] = adjusted_p_value
+
+    return control_results, arms_results, omnibus_p_value
+
+
+def build_multi_arm_results(study, conversions_by_group, group_sizes):
+    """
+    Build the results payload for a given multi-arm study.
+
+    Args:
+        study (dict): Study information, as stored in the lift_studies table.
+        conversions_by_group (dict): Number of conversions for each group name.
+        group_sizes (dict): Size of each group.
+
+    Returns:
+        results (dict): Results for the study.
+    """
+    control_results, arms_results, omnibus_p_value = get_multi_arm_stats(
+        conversions_by_group, group_sizes
+    )
+
+    return {
+        "name": study["name"],
+        "start_date": study["start_date"].strftime("%Y-%m-%d"),
+        "end_date": study["end_date"].strftime("%Y-%m-%d"),
+        "sample_size": str(study["sample_size"]),
+        "control_num_conversions": str(control_results["conversions"]),
+        "control_group_size": str(group_sizes.get("control", 0)),
+        "control_conversion_rate": str(round(control_results["conversion_rate"], 4)),
+        "control_conversion_rate_confidence_interval": str(
+            control_results["confidence_interval"]
+        ),
+        "arms": {
+            arm_name: {
+                "num_conversions": str(arm["results"]["conversions"]),
+                "group_size": str(group_sizes[arm_name]),
+                "conversion_rate": str(round(arm["results"]["conversion_rate"], 4)),
+                "conversion_rate_confidence_interval": str(
+                    arm["results"]["confidence_interval"]
+                ),
+                "lift": str(round(arm["lift"], 4)),
+                "p_value": str(round(arm["p_value"], 4)),
+                "adjusted_p_value": str(round(arm["adjusted_p_value"], 4)),
+            }
+            for arm_name, arm in arms_results.items()
+        },
+        "omnibus_p_value": str(round(omnibus_p_value, 4)),
+        "p_value_correction": "holm",
+    }
+
+
+def accumulate_value_sums(value_sums, group_names, values):
+    """
+    Add a batch of per-user conversion values to the running sums of each group.
+
+    Args:
+        value_sums (dict): Running sums for each group name, updated in place.
+        group_names (numpy.ndarray): Group of each user in the batch.
+        values (numpy.ndarray): Total conversion value of each user in the batch.
+
+    Returns:
+        value_sums (dict): Running sums for each group name. Each entry contains the
+            number of converters, the sum of the values and the sum of their squares.
+    """
+    codes, groups = pd.factorize(group_names)
+    valid = codes >= 0
+    codes = codes[valid]
+    values = np.asarray(values, dtype=np.float64)[valid]
+
+    converters = np.bincount(codes, minlength=len(groups))
+    totals = np.bincount(codes, weights=values, minlength=len(groups))
+    squares = np.bincount(codes, weights=values * values, minlength=len(groups))
+
+    for i, group_name in enumerate(groups):
+        sums = value_sums.setdefault(
+            group_name, {"converters": 0, "sum": 0.0, "sum_sq": 0.0}
+        )
+        sums["converters"] += int(converters[i])
+        sums["sum"] += float(totals[i])
+        sums["sum_sq"] += float(squares[i])
+
+    return value_sums
+
+
+def get_value_results_for_group(value_sums, group_size, alpha: float = 0.05):
+    """
+    Get value results for a given study group. Members without conversions count
+    as a value of 0.
+
+    Args:
+        value_sums (dict): Running sums of the group, see accumulate_value_sums.
+        group_size (int): Number of customers in the group.
+        alpha (float): Significance level of the confidence interval.
+
+    Returns:
+        dict: Results for the group. Contains the following keys:
+            conversions (int): Number of customers with conversions in the group.
+            total_value (float): Sum of the conversion values in the group.
+            mean_value (float): Mean conversion value per customer in the group.
+            variance (float): Sample variance of the value per customer.
+            confidence_interval (list): Confidence interval for the mean value.
+    """
+    total = value_sums["sum"]
+    mean = total / group_size if group_size > 0 else 0
+    variance = (
+        max(value_sums["sum_sq"] - total * mean, 0) / (group_size - 1)
+        if group_size > 1
+        else 0
+    )
+    dist = (
+        norm.isf(alpha / 2.0) * np.sqrt(variance / group_size) if group_size > 0 else 0
+    )
+
+    return {
+        "conversions": value_sums["converters"],
+        "total_value": total,
+        "mean_value": mean,
+        "variance": variance,
+        "confidence_interval": [
+            round(float(mean - dist), 4),
+            round(float(mean + dist), 4),
+        ],
+    }
+
+
+def calculate_welch_p_value(
+    control_results, control_group_size, test_results, test_group_size
+):
+    """
+    Calculate p-value of Welch's t-test for the difference between mean values.
+
+    Args:
+        control_results (dict): Value results for the control group.
+        control_group_size (int): Control group size.
+        test_results (dict): Value results for the test group.
+        test_group_size (int): Test group size.
+
+    Returns:
+        float: P-value.
+    """
+    if control_results["variance"] == 0 and test_results["variance"] == 0:
+        return np.nan
+
+    return float(
+        ttest_ind_from_stats(
+            test_results["mean_value"],
+            np.sqrt(test_results["variance"]),
+            test_group_size,
+            control_results["mean_value"],
+            np.sqrt(control_results["variance"]),
+            control_group_size,
+            equal_var=False,
+        ).pvalue
+    )
+
+
+def get_value_study_stats(value_sums_by_group, control_group_size, test_group_size):
+    """
+    Get value metrics for a given study.
+
+    Args:
+        value_sums_by_group (dict): Running sums for each group name, see accumulate_value_sums.
+        control_group_size (int): Size of the control group.
+        test_group_size (int): Size of the test group.
+
+    Returns:
+        control_results (dict): Value results for the control group.
+        test_results (dict): Value results for the test group.
+        lift_perc (float): Lift percentage of the mean value per customer.
+        p_value (float): P-value for the difference between mean values.
+    """
+    empty = {"converters": 0, "sum": 0.0, "sum_sq": 0.0}
+    control_results = get_value_results_for_group(
+        value_sums_by_group.get("control", empty), control_group_size
+    )
+    test_results = get_value_results_for_group(
+        value_sums_by_group.get("test", empty), test_group_size
+    )
+
+    p_value = calculate_welch_p_value(
+        control_results, control_group_size, test_results, test_group_size
+    )
+    lift_perc = float(
+        calculate_lift(test_results["mean_value"], control_results["mean_value"])
+    )
+
+    return control_results, test_results, lift_perc, p_value
+
+
+def build_value_study_results(study, value_sums_by_group):
+    """
+    Build the value results payload for a given study.
+
+    Args:
+        study (dict): Study information, as stored in the lift_studies table.
+        value_sums_by_group (dict): Running sums for each group name, see accumulate_value_sums.
+
+    Returns:
+        results (dict): Value results for the study.
+    """
+    control_group_size = study["control_group_size"]
+    test_group_size = study["test_group_size"]
+
+    (control_results, test_results, lift_perc, p_value) = get_value_study_stats(
+        value_sums_by_group, control_group_size, test_group_size
+    )
+
+    # value the test group made on top of what it would have made without messages
+    incremental_value = (
+        test_results["mean_value"] - control_results["mean_value"]
+    ) * test_group_size
+
+    return {
+        "name": study["name"],
+        "start_date": study["start_date"].strftime("%Y-%m-%d"),
+        "end_date": study["end_date"].strftime("%Y-%m-%d"),
+        "sample_size": str(study["sample_size"]),
+        "test_num_conversions": str(test_results["conversions"]),
+        "test_group_size": str(test_group_size),
+        "test_total_value": str(round(test_results["total_value"], 2)),
+        "test_value_per_member": str(round(test_results["mean_value"], 4)),
+        "test_value_per_member_confidence_interval": str(
+            test_results["confidence_interval"]
+        ),
+        "control_num_conversions": str(control_results["conversions"]),
+        "control_group_size": str(control_group_size),
+        "control_total_value": str(round(control_results["total_value"], 2)),
+        "control_value_per_member": str(round(control_results["mean_value"], 4)),
+        "control_value_per_member_confidence_interval": str(
+            control_results["confidence_interval"]
+        ),
+        "value_lift": str(round(lift_perc, 4)),
+        "incremental_value": str(round(incremental_value, 2)),
+        "p_value": str(round(p_value, 4)),
+    }
+
+
+def count_cuped_flags_by_group(conversion_flags):
+    """
+    Count the members of each group that converted during the study, during the
+    pre-period, and during both.
+
+    Args:
+        conversion_flags (pandas.DataFrame): Conversion flags of the members, see
+            filter_conversions_with_pre_period.
+
+    Returns:
+        cuped_counts_by_group (dict): Counts for each group name, with the in_study,
+            pre_period and both keys.
+    """
+    flags = conversion_flags.assign(
+        both=conversion_flags["in_study"] & conversion_flags["pre_period"]
+    )
+    counts = flags.groupby("group_name")[["in_study", "pre_period", "both"]].sum()
+
+    return {
+        group_name: {key: int(value) for key, value in row.items()}
+        for group_name, row in counts.iterrows()
+    }
+
+
+def get_cuped_results_for_group(
+    counts, group_size, theta, mean_pre, alpha: float = 0.05
+):
+    """
+    Get CUPED adjusted results for a given study group.
+
+    The outcome of each member is whether they converted during the study, and the
+    covariate is whether they converted during the pre-period. The adjusted rate
+    is an unbiased estimate of the conversion rate, but it is not bounded to
+    [0, 1], and neither is its confidence interval: clipping either would bias
+    the lift and make the rate disagree with its interval.
+
+    Args:
+        counts (dict): CUPED counts of the group, see count_cuped_flags_by_group.
+        group_size (int): Number of customers in the group.
+        theta (float): CUPED coefficient, pooled over all groups.
+        mean_pre (float): Pre-period conversion rate, pooled over all groups.
+        alpha (float): Significance level of the confidence interval.
+
+    Returns:
+        dict: Results for the group. Contains the following keys:
+            conversion_rate (float): Adjusted conversion rate in the group, unbounded.
+            variance (float): Variance of the adjusted outcome per customer.
+            confidence_interval (list): Confidence interval for the adjusted conversion
+                rate, unbounded.
+    """
+    mean_y = counts["in_study"] / group_size
+    mean_x = counts["pre_period"] / group_size
+    # outcome and covariate are binary, so their sums of squares are their sums
+    var_y = counts["in_study"] * (1 - mean_y) / (group_size - 1)
+    var_x = counts["pre_period"] * (1 - mean_x) / (group_size - 1)
+    cov_xy = (counts["both"] - group_size * mean_x * mean_y) / (group_size - 1)
+
+    conversion_rate = mean_y - theta * (mean_x - mean_pre)
+    variance = max(var_y + theta**2 * var_x - 2 * theta * cov_xy, 0)
+
+    dist = norm.isf(alpha / 2.0) * np.sqrt(variance / group_size)
+    ci_low, ci_upp = conversion_rate - dist, conversion_rate + dist
+
+    return {
+        "conversion_rate": conversion_rate,
+        "variance": variance,
+        "confidence_interval": [round(float(ci_low), 4), round(float(ci_upp), 4)],
+    }
+
+
+def get_cuped_study_stats(cuped_counts_by_group, control_group_size, test_group_size):
+    """
+    Get CUPED adjusted metrics for a given study.
+
+    Args:
+        cuped_counts_by_group (dict): CUPED counts for each group name, see count_cuped_flags_by_group.
+        control_group_size (int): Size of the control group.
+        test_group_size (int): Size of the test group.
+
+    Returns:
+        control_results (dict): Adjusted results for the control group.
+        test_results (dict): Adjusted results for the test group.
+        lift_perc (float): Adjusted lift percentage.
+        p_value (float): P-value for the difference between adjusted conversion rates.
+        theta (float): CUPED coefficient.
+    """
+    empty = {"in_study": 0, "pre_period": 0, "both": 0}
+    control_counts = cuped_counts_by_group.get("control", empty)
+    test_counts = cuped_counts_by_group.get("test", empty)
+
+    # pooled covariance between the outcome and the covariate
+    n = control_group_size + test_group_size
+    sum_y = control_counts["in_study"] + test_counts["in_study"]
+    sum_x = control_counts["pre_period"] + test_counts["pre_period"]
+    sum_xy = control_counts["both"] + test_counts["both"]
+    mean_y = sum_y / n
+    mean_x = sum_x / n
+    var_x = sum_x * (1 - mean_x) / (n - 1)
+    cov_xy = (sum_xy - n * mean_x * mean_y) / (n - 1)
+    theta = cov_xy / var_x if var_x > 0 else 0.0
+
+    control_results = get_cuped_results_for_group(
+        control_counts, control_group_size, theta, mean_x
+    )
+    test_results = get_cuped_results_for_group(
+        test_counts, test_group_size, theta, mean_x
+    )
+
+    std_err = np.sqrt(
+        control_results["variance"] / control_group_size
+        + test_results["variance"] / test_group_size
+    )
+    p_value = (
+        2
+        * norm.sf(
+            abs(test_results["conversion_rate"] - control_results["conversion_rate"])
+            / std_err
+        )
+        if std_err > 0
+        else np.nan
+    )
+    lift_perc = calculate_lift(
+        test_results["conversion_rate"], control_results["conversion_rate"]
+    )
+
+    return control_results, test_results, lift_perc, p_value, theta
+
+
+def build_cuped_results(study, cuped_counts_by_group):
+    """
+    Build the CUPED adjusted results payload for a given study.
+
+    Args:
+        study (dict): Study information, as stored in the lift_studies table.
+        cuped_counts_by_group (dict): CUPED counts for each group name, see count_cuped_flags_by_group.
+
+    Returns:
+        results (dict): CUPED adjusted results, to report next to the unadjusted ones.
+            Adjusted rates and their confidence intervals may fall outside [0, 1].
+    """
+    (control_results, test_results, lift_perc, p_value, theta) = get_cuped_study_stats(
+        cuped_counts_by_group, study["control_group_size"], study["test_group_size"]
+    )
+
+    return {
+        "cuped_theta": str(round(theta, 4)),
+        "cuped_test_conversion_rate": str(round(test_results["conversion_rate"], 4)),
+        "cuped_test_conversion_rate_confidence_interval": str(
+            test_results["confidence_interval"]
+        ),
+        "cuped_control_conversion_rate": str(
+            round(control_results["conversion_rate"], 4)
+        ),
+        "cuped_control_conversion_rate_confidence_interval": str(
+            control_results["confidence_interval"]
+        ),
+        "cuped_lift": str(round(lift_perc, 4)),
+        "cuped_p_value": str(round(p_value, 4)),
+    }
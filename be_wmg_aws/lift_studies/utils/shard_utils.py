@@ -0,0 +1,185 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import io
+import multiprocessing
+import threading
+from multiprocessing.connection import wait
+
+import numpy as np
+import pandas as pd
+from utils.data_utils import normalize_user_phones, open_decompressed_stream
+from utils.lift_utils import get_conversions_in_window, get_phone_keys
+
+# bytes of decompressed CSV handed to a worker at a time
+SHARD_BLOCK_SIZE = 64 * 1024 * 1024
+# columns of the events file the workers parse
+SHARD_COLUMNS = ["event_name", "event_time", "user_phone"]
+
+
+def iter_csv_blocks(chunks, block_size: int = SHARD_BLOCK_SIZE):
+    """
+    Split a (possibly compressed) CSV stream into blocks of whole lines.
+
+    Each block starts with the header line, so it can be parsed on its own.
+
+    Args:
+        chunks (iterable): Iterable of bytes chunks with the raw file content.
+        block_size (int): Approximate size of each block, in bytes.
+
+    Returns:
+        blocks (iterator): Blocks of decompressed CSV, each with the header line.
+    """
+    with open_decompressed_stream(chunks) as data:
+        header = data.readline()
+        tail = b""
+        while block := data.read(block_size):
+            block = tail + block
+            # the last line of the block continues in the next one
+            cut = block.rfind(b"\n") + 1
+            tail = block[cut:]
+            if cut:
+                yield header + block[:cut]
+        if tail:
+            yield header + tail
+
+
+def get_member_converters(
+    block: bytes, start_date, end_date, conversion_event_name, membership
+) -> dict:
+    """
+    Get the members of each group with a conversion in a block of the events file.
+
+    Args:
+        block (bytes): Block of CSV, with the header line.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        conversion_event_name (str): Name of the conversion event.
+        membership (StudyMembership): Members of each group of the study.
+
+    Returns:
+        members (dict): Sorted unique phone keys of the converted members of each group.
+    """
+    conversions = pd.read_csv(io.BytesIO(block), usecols=SHARD_COLUMNS)
+    # parse the times and phones of the conversion event only
+    conversions = normalize_user_phones(
+        conversions[conversions["event_name"].eq(conversion_event_name)].copy()
+    )
+    conversions["event_time"] = pd.to_datetime(conversions["event_time"])
+    conversions = get_conversions_in_window(
+        conversions, start_date, end_date, conversion_event_name
+    )
+
+    return membership.intersect(get_phone_keys(conversions["user_phone"]))
+
+
+def _shard_worker(conn, start_date, end_date, conversion_event_name, membership):
+    # the membership is inherited from the parent process when it is forked
+    members = {group_name: [] for group_name in membership.keys}
+    try:
+        while block := conn.recv_bytes():
+            for group_name, group_keys in get_member_converters(
+                block, start_date, end_date, conversion_event_name, membership
+            ).items():
+                members[group_name].append(group_keys)
+            conn.send(None)
+        conn.send(
+            {
+                group_name: np.unique(np.concatenate(keys or [np.empty(0, np.int64)]))
+                for group_name, keys in members.items()
+            }
+        )
+    except Exception as e:
+        conn.send(e)
+    finally:
+        conn.close()
+
+
+def count_member_conversions_sharded(
+    chunks, start_date, end_date, conversion_event_name, membership, workers: int
+) -> dict:
+    """
+    Count the members of each group with a conversion within the study's timeframe,
+    parsing and filtering the events file in worker processes.
+
+    The stream is decompressed and split into blocks of whole lines in this process,
+    and each block is parsed by the next idle worker. Workers only send back the
+    unique phone keys of the converted members of each group, merged here.
+
+    Workers are forked processes talking through pipes, as Lambda has no shared
+    memory for multiprocessing pools and queues. Forking a process with other
+    threads running may deadlock the workers on a lock held by one of them, so it
+    must be called from the main thread.
+
+    Args:
+        chunks (iterable): Iterable of bytes chunks with the raw events file.
+        start_date (datetime.date): Start date of the study.
+        end_date (datetime.date): End date of the study.
+        conversion_event_name (str): Name of the conversion event.
+        membership (StudyMembership): Members of each group of the study.
+        workers (int): Number of worker processes.
+
+    Returns:
+        conversions_by_group (dict): Number of conversions for each group name.
+    """
+    assert threading.current_thread() is threading.main_thread(), (
+        "Sharded parsing must run in the main thread."
+    )
+
+    context = multiprocessing.get_context("fork")
+    processes, conns = [], []
+    for _ in range(workers):
+        conn, worker_conn = context.Pipe()
+        process = context.Process(
+            target=_shard_worker,
+            args=(
+                worker_conn,
+                start_date,
+                end_date,
+                conversion_event_name,
+                membership,
+            ),
+            daemon=True,
+        )
+        process.start()
+        worker_conn.close()
+        processes.append(process)
+        conns.append(conn)
+
+    def check(reply):
+        if isinstance(reply, Exception):
+            raise Exception("Error while parsing a block of the events file.", reply)
+
+    try:
+        idle = list(conns)
+        for block in iter_csv_blocks(chunks):
+            while not idle:
+                for conn in wait(conns):
+                    check(conn.recv())
+                    idle.append(conn)
+            idle.pop().send_bytes(block)
+
+        # an empty block tells the workers to send back their members
+        members = {group_name: [] for group_name in membership.keys}
+        for conn in conns:
+            if conn not in idle:
+                check(conn.recv())
+            conn.send_bytes(b"")
+            reply = conn.recv()
+            check(reply)
+            for group_name, group_keys in reply.items():
+                members[group_name].append(group_keys)
+    finally:
+        for conn in conns:
+            conn.close()
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+
+    return {
+        group_name: len(np.unique(np.concatenate(keys)))
+        for group_name, keys in members.items()
+    }
@@ -17,6 +17,17 @@ const dbSecretArn = process.env.DB_SECRET_ARN;
 const db_name = process.env.DB_NAME;
 let dbPass;
 
+// splitmix64 constants for the hash assignment mode, lift_utils.py implements the same hash
+const UINT64_MASK = 0xFFFFFFFFFFFFFFFFn;
+const SPLITMIX64_GAMMA = 0x9E3779B97F4A7C15n;
+const SPLITMIX64_MUL_1 = 0xBF58476D1CE4E5B9n;
+const SPLITMIX64_MUL_2 = 0x94D049BB133111EBn;
+
+// the active studies are reused by warm invocations for a few seconds, instead of
+// being looked up for every template message
+const activeStudyTtlMs = parseFloat(process.env.ACTIVE_STUDY_TTL_SECONDS || '5') * 1000;
+let activeStudiesCache = { studiesByTemplate: new Map(), expiresAt: 0 };
+
 const sqs = new SQSClient({});
 export const lambdaHandler = async (event, context) => {
     let connection;
@@ -30,67 +41,79 @@ export const lambdaHandler = async (event, context) => {
                 dbPass = await getDatabasePassword();
                 connection = createConnection();
 
-                // Check if there is an active lift study
-                const activeStudyId = await getActiveStudyId(connection);
+                // Check if this is an initial template of an active lift study,
+                // active studies do not share templates
+                const templateName = request_data.template.name;
+                const activeStudiesByTemplate = await getActiveStudiesByTemplate(connection);
+                const activeStudyId = activeStudiesByTemplate.get(templateName);
                 if (activeStudyId != null) {
-                    console.info('Active lift study found.');
-                    // Check if this is an initial template for the active study
-                    const templateName = request_data.template.name;
-                    const lift_study_templates = await getStudyTemplates(connection, activeStudyId);
-                    console.info('Checking if template ' + templateName + ' is in the study templates: ' + lift_study_templates.toString());
-                    if (lift_study_templates.includes(templateName)) {
-                        // Check if the phone number is already assigned to a group
-                        const phoneNumber = request_data.to;
-                        let phoneGroup = await getPhoneGroup(connection, activeStudyId, phoneNumber);
-                        if (phoneGroup == null) {
-                            console.info('Phone not assigned to any group.');
-                            // The phone number is not assigned to any group, check if both groups are available for assignment
-                            const groupsStatus = await getGroupsStatus(connection, activeStudyId);
-                            if (groupsStatus.control_full == 0 && groupsStatus.test_full == 0) {
-                                // Randomly assign the phone to either group
-                                const randomByte = crypto.randomBytes(1)[0];
-                                phoneGroup = randomByte < 128 ? 'test' : 'control';
-                                await assignPhoneToGroup(connection, activeStudyId, phoneNumber, phoneGroup);
-                                console.info('Phone randomly assigned to group: ' + phoneGroup);
-                            }
-                            // If at least one group is full, check if only one group is full
-                            else if (groupsStatus.control_full == 0 || groupsStatus.test_full == 0) {
-                                // Only one group is full, assign the phone number to the other group
-                                phoneGroup = groupsStatus.control_full == 0 ? 'control' : 'test';
+                    console.info('Template ' + templateName + ' is in active lift study ' + activeStudyId);
+                    // Check if the phone number is already assigned to a group
+                    const phoneNumber = request_data.to;
+                    let phoneGroup = await getPhoneGroup(connection, activeStudyId, phoneNumber);
+                    if (phoneGroup == null) {
+                        console.info('Phone not assigned to any group.');
+                        // The phone number is not assigned to any group, check if both groups are available for assignment
+                        const groupsStatus = await getGroupsStatus(connection, activeStudyId);
+                        if (groupsStatus.arm_names) {
+                            // Members of multi-arm studies are assigned in bulk before the study starts
+                            console.info('Phone not in the audience of the multi-arm study.');
+                        }
+                        else if (groupsStatus.assignment_mode == 'hash') {
+                            // The group is given by the hash of the phone number, assign it only if the group is not full
+                            const hashGroup = getHashGroup(activeStudyId, groupsStatus.assignment_salt, phoneNumber);
+                            if (hashGroup != null && groupsStatus[hashGroup + '_full'] == 0) {
+                                phoneGroup = hashGroup;
                                 await assignPhoneToGroup(connection, activeStudyId, phoneNumber, phoneGroup);
-                                console.info('Phone assigned to group: ' + phoneGroup);
+                                console.info('Phone assigned by hash to group: ' + phoneGroup);
                             }
-                            // If both groups are full, none of the blocks above run and no group is assigned
                         }
-
-                        if (phoneGroup == 'control') {
-                            // Drop the message if the phone group is control
-                            console.info('Message dropped: phone number in control group');
-                            return {
-                                statusCode: 200,
-                                headers: { 'Content-Type': 'application/json' },
-                                body: JSON.stringify({
-                                    "messaging_product": "whatsapp",
-                                    "contacts": [
-                                        {
-                                            "input": phoneNumber,
-                                            "wa_id": phoneNumber
-                                        }
-                                    ],
-                                    "messages": [
-                                        {
-                                            "id": "wamid." + crypto.randomBytes(28).toString('hex'),
-                                            "message_status": "accepted"
-                                        }
-                                    ]
-                                })
-                            };
+                        else if (groupsStatus.control_full == 0 && groupsStatus.test_full == 0) {
+                            // Randomly assign the phone to either group
+                            const randomByte = crypto.randomBytes(1)[0];
+                            phoneGroup = randomByte < 128 ? 'test' : 'control';
+                            await assignPhoneToGroup(connection, activeStudyId, phoneNumber, phoneGroup);
+                            console.info('Phone randomly assigned to group: ' + phoneGroup);
                         }
-                        else if (phoneGroup == 'test'){
-                            // Increment the messages counter if the phone group is test
-                            await incrementMessagesCount(connection, activeStudyId);
-                            console.info('Incremented lift study messages count.');
+                        // If at least one group is full, check if only one group is full
+                        else if (groupsStatus.control_full == 0 || groupsStatus.test_full == 0) {
+                            // Only one group is full, assign the phone number to the other group
+                            phoneGroup = groupsStatus.control_full == 0 ? 'control' : 'test';
+                            await assignPhoneToGroup(connection, activeStudyId, phoneNumber, phoneGroup);
+                            console.info('Phone assigned to group: ' + phoneGroup);
                         }
+                        // If both groups are full, none of the blocks above run and no group is assigned
+                    }
+
+                    // The arms of a multi-arm study are named after their template, and only receive that template
+                    const isOtherArm = phoneGroup != null && phoneGroup != 'control' && phoneGroup != 'test' && phoneGroup != templateName;
+                    if (phoneGroup == 'control' || isOtherArm) {
+                        // Drop the message if the phone group is control, or the arm of another template
+                        console.info('Message dropped: phone number in group ' + phoneGroup);
+                        return {
+                            statusCode: 200,
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify({
+                                "messaging_product": "whatsapp",
+                                "contacts": [
+                                    {
+                                        "input": phoneNumber,
+                                        "wa_id": phoneNumber
+                                    }
+                                ],
+                                "messages": [
+                                    {
+                                        "id": "wamid." + crypto.randomBytes(28).toString('hex'),
+                                        "message_status": "accepted"
+                                    }
+                                ]
+                            })
+                        };
+                    }
+                    else if (phoneGroup != null){
+                        // Increment the messages counter if the phone group is test (or the arm of the template)
+                        await incrementMessagesCount(connection, activeStudyId);
+                        console.info('Incremented lift study messages count.');
                     }
                 }
             }
@@ -144,43 +167,53 @@ export const lambdaHandler = async (event, context) => {
     }
 };
 
-// Helper function to get the id of the active study
-const getActiveStudyId = async (connection) => {
+// Helper function to get the active studies, as a map of template name to study id
+const getActiveStudiesByTemplate = async (connection) => {
+    if (Date.now() < activeStudiesCache.expiresAt) {
+        return activeStudiesCache.studiesByTemplate;
+    }
+
     const queryStr = `
-      SELECT id
+      SELECT id, template_names
       FROM lift_studies
       WHERE status = 'active'
         AND start_date <= CURRENT_DATE
-        AND end_date >= CURRENT_DATE;
+        AND end_date >= CURRENT_DATE
+      ORDER BY start_date, id;
     `;
 
-    const activeStudy = await queryDatabase(connection, queryStr);
+    const activeStudies = await queryDatabase(connection, queryStr);
+    const studiesByTemplate = new Map();
+    for (const study of activeStudies) {
+        for (const templateName of (study.template_names || '').split(',')) {
+            if (!templateName) {
+                continue;
+            }
+            // Keep the earliest study, the lift studies API should prevent this
+            if (studiesByTemplate.has(templateName)) {
+                console.error('Template ' + templateName + ' is in active lift studies ' + studiesByTemplate.get(templateName) + ' and ' + study.id);
+                continue;
+            }
+            studiesByTemplate.set(templateName, study.id);
+        }
+    }
+    activeStudiesCache = { studiesByTemplate, expiresAt: Date.now() + activeStudyTtlMs };
 
-    return activeStudy.length == 1 ? activeStudy[0].id : null;
+    return studiesByTemplate;
 };
 
-// Helper function to get the list of templates for a given study
-const getStudyTemplates = async (connection, studyId) => {
-    const queryStr = `
-      SELECT template_names
-      FROM lift_studies
-      WHERE id = ?;
-    `;
-    const study_templates = await queryDatabase(connection, queryStr, [studyId]);
-
-    return study_templates.length == 1 ? study_templates[0].template_names.split(",") : [];
-}
-
 // Helper function to get the group of a given phone number for a given study
 const getPhoneGroup = async (connection, studyId, phoneNumber) => {
     const queryStr = `
       SELECT group_name
       FROM lift_studies_groups
       WHERE study_id = ?
-        AND phone_number = ?
+        AND phone_number IN (?, ?)
+      LIMIT 1
     `;
 
-    const phoneGroup = await queryDatabase(connection, queryStr, [studyId, phoneNumber]);
+    // Audiences assigned in bulk are stored with digits only
+    const phoneGroup = await queryDatabase(connection, queryStr, [studyId, phoneNumber, phoneNumber.replace(/[^0-9]/g, '')]);
 
     return phoneGroup.length == 1 ? phoneGroup[0].group_name : null;
 };
@@ -190,7 +223,10 @@ const getGroupsStatus = async (connection, studyId) => {
     const queryStr = `
       SELECT
         (control_group_size = sample_size) AS control_full,
-        (test_group_size = sample_size) AS test_full
+        (test_group_size = sample_size) AS test_full,
+        assignment_mode,
+        assignment_salt,
+        arm_names
       FROM lift_studies
       WHERE id = ?
     `;
@@ -200,6 +236,23 @@ const getGroupsStatus = async (connection, studyId) => {
     return groupsStatus[0];
 };
 
+// Helper function to get the group of a phone number in the hash assignment mode
+// The group is the top bit of a splitmix64 hash of the phone number keyed by sha256("studyId:salt")
+const getHashGroup = (studyId, salt, phoneNumber) => {
+    const digits = phoneNumber.replace(/[^0-9]/g, '');
+    if (!/^[0-9]{1,18}$/.test(digits)) {
+        return null;
+    }
+
+    const key = crypto.createHash('sha256').update(`${studyId}:${salt}`).digest().readBigUInt64LE(0);
+    let z = ((BigInt(digits) ^ key) + SPLITMIX64_GAMMA) & UINT64_MASK;
+    z = ((z ^ (z >> 30n)) * SPLITMIX64_MUL_1) & UINT64_MASK;
+    z = ((z ^ (z >> 27n)) * SPLITMIX64_MUL_2) & UINT64_MASK;
+    z = z ^ (z >> 31n);
+
+    return (z >> 63n) == 1n ? 'test' : 'control';
+};
+
 // Helper function to set the group of a given phone number for a given study
 const assignPhoneToGroup = async (connection, studyId, phoneNumber, groupName) => {
     const strGroupQuery = `
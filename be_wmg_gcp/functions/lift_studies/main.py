@@ -5,7 +5,11 @@ import uuid
 
 sys.path.append(os.path.dirname(__file__))
 
-from utils.data_utils import LiftCloudStorageHandler, LiftDatabaseHandler
+from utils.data_utils import (
+    LiftCloudStorageHandler,
+    LiftConnectionPool,
+    LiftDatabaseHandler,
+)
 from utils.lift_utils import (
     calculate_cost_per_incremental_conversion,
     filter_conversions,
@@ -19,9 +23,18 @@ db_name = os.environ.get("DB_NAME", None)
 db_user = os.environ.get("DB_USER", None)
 db_secret_name = os.environ.get("DB_SECRET_NAME", None)
 bucket_name = os.environ.get("BUCKET_NAME", None)
-
-# initialize database handler
-db = LiftDatabaseHandler()
+# events file may be plain, gzip or zstd compressed CSV
+events_file_key = os.environ.get("EVENTS_FILE_KEY", "events.csv")
+
+# connections are shared by the concurrent requests of the instance, and each
+# request uses its own session
+db_pool = LiftConnectionPool(
+    db_host,
+    db_name,
+    db_user,
+    db_secret_name,
+    pool_size=int(os.environ.get("DB_POOL_SIZE", 8)),
+)
 
 
 def lift_studies_handler(event):
@@ -58,7 +71,8 @@ def lift_studies_handler(event):
                 "Missing required fields in request body."
             )
 
-            study_id = create_lift_study(request_data)
+            with db_pool.session() as db:
+                study_id = create_lift_study(db, request_data)
 
             return {"study_id": study_id}, 200
         except Exception as e:
@@ -72,7 +86,8 @@ def lift_studies_handler(event):
                 "Conversion event name must be specified in the format conversion_event=<your event>"
             )
 
-            results = get_lift_study_results(study_id, conversion_event_name)
+            with db_pool.session() as db:
+                results = get_lift_study_results(db, study_id, conversion_event_name)
 
             return results, 200
 
@@ -85,7 +100,8 @@ def lift_studies_handler(event):
         print("Updating Lift Study Status")
         try:
             updated_fields = []
-            updated_fields = update_lift_study_data(study_id, request_data)
+            with db_pool.session() as db:
+                updated_fields = update_lift_study_data(db, study_id, request_data)
 
             return {"updated_fields": updated_fields}, 200
 
@@ -95,19 +111,17 @@ def lift_studies_handler(event):
     return {"message": "Invalid HTTP method."}, 405
 
 
-def create_lift_study(study_data):
+def create_lift_study(db: LiftDatabaseHandler, study_data):
     """
     Create a new lift study.
 
     Args:
+        db (LiftDatabaseHandler): Database session of the request.
         study_data (dict): Dictionary containing the study information.
 
     Returns:
         study_id (str): ID of the created study.
     """
-    # connect to the database
-    db.connect(db_host, db_name, db_user, db_secret_name)
-
     # check if there is another active study
     assert db.get_active_study_id() is None, "There is an active study running."
 
@@ -125,25 +139,24 @@ def create_lift_study(study_data):
         "status": "active",
     }
     db.upload_new_study(study_info)
-    db.close()
 
     return study_id
 
 
-def get_lift_study_results(study_id: str, conversion_event_name: str):
+def get_lift_study_results(
+    db: LiftDatabaseHandler, study_id: str, conversion_event_name: str
+):
     """
     Get results for a given lift study.
 
     Args:
+        db (LiftDatabaseHandler): Database session of the request.
         study_id (str): ID of the study to get results for.
         conversion_event_name (str): Name of the conversion event to get results for.
 
     Returns:
         results (dict): Results for the study.
     """
-    # connect to the database
-    db.connect(db_host, db_name, db_user, db_secret_name)
-
     # check if the study exists
     assert db.exists_study_with_id(study_id), f"Study {study_id} does not exist."
 
@@ -173,7 +186,7 @@ def get_lift_study_results(study_id: str, conversion_event_name: str):
         raise Exception(f"Error while fetching data for study {study_id}.", e)
 
     try:
-        conversions = storage.get_conversions(bucket_name, "events.csv")
+        conversions = storage.get_conversions(bucket_name, events_file_key)
 
         # get the study groups
         study_groups = db.read_table(
@@ -227,25 +240,21 @@ def get_lift_study_results(study_id: str, conversion_event_name: str):
         "p_value": round(p_value, 4),
     }
 
-    db.close()
-
     return results
 
 
-def update_lift_study_data(study_id: str, request_data: dict):
+def update_lift_study_data(db: LiftDatabaseHandler, study_id: str, request_data: dict):
     """
     Update lift study data.
 
     Args:
+        db (LiftDatabaseHandler): Database session of the request.
         study_id (str): ID of the study to update.
         request_data (dict): Data to update.
 
     Returns:
         updated_fields (dict): Dictionary containing the updated fields.
     """
-    # connect to the database
-    db.connect(db_host, db_name, db_user, db_secret_name)
-
     # check if the study exists
     assert db.exists_study_with_id(study_id), f"Study {study_id} does not exist."
 
@@ -277,6 +286,4 @@ def update_lift_study_data(study_id: str, request_data: dict):
         db.update_lift_study_data(study_id, "avg_message_cost", float(new_avg_msg_cost))
         updated_fields["avg_message_cost"] = new_avg_msg_cost
 
-    db.close()
-
     return updated_fields
@@ -1,8 +1,103 @@
-from io import StringIO
+import gzip
+import io
+import itertools
+import threading
+from contextlib import contextmanager
 
 import mysql.connector
 import pandas as pd
 from google.cloud import secretmanager, storage
+from mysql.connector import pooling
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+STREAM_CHUNK_SIZE = 1024 * 1024
+# seconds a request waits for a pooled connection when all are in use
+POOL_TIMEOUT_SECONDS = 30
+
+
+class ChunkedStream(io.RawIOBase):
+    """
+    Read-only file-like object over an iterator of byte chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b""
+                return 0
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def open_decompressed_stream(chunks):
+    """
+    Wrap a stream of raw file bytes with the matching streaming decompressor.
+
+    The compression format is detected from the magic bytes at the start of the
+    stream, so plain, gzip and zstd files can be read through the same path.
+    Bytes are only decompressed as the consumer reads them.
+
+    Args:
+        chunks (iterable): Iterable of bytes chunks with the raw file content.
+
+    Returns:
+        stream (io.BufferedIOBase): Binary file-like object with the decompressed content.
+    """
+    chunks = iter(chunks)
+    head = b""
+    # the first chunk may be shorter than the magic number
+    while len(head) < len(ZSTD_MAGIC):
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        head += chunk
+
+    raw = io.BufferedReader(
+        ChunkedStream(itertools.chain([head], chunks)), buffer_size=STREAM_CHUNK_SIZE
+    )
+
+    if head.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if head.startswith(ZSTD_MAGIC):
+        # only needed for zstd compressed files
+        import zstandard
+
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(
+                raw, read_size=STREAM_CHUNK_SIZE
+            ),
+            buffer_size=STREAM_CHUNK_SIZE,
+        )
+    return raw
+
+
+def read_conversions_csv(stream) -> pd.DataFrame:
+    """
+    Parse conversion data from a (possibly compressed) CSV stream.
+
+    Args:
+        stream (iterable): Iterable of bytes chunks with the raw file content.
+
+    Returns:
+        conversions (pandas.DataFrame): DataFrame containing the conversion data.
+    """
+    with open_decompressed_stream(stream) as data:
+        conversions = pd.read_csv(data)
+    conversions["event_time"] = pd.to_datetime(conversions["event_time"])
+
+    return conversions
 
 
 class LiftCloudStorageHandler:
@@ -30,10 +125,30 @@ class LiftCloudStorageHandler:
 
         return content
 
+    def stream_file(self, bucket: str, file_key: str):
+        """
+        Stream the raw bytes of a file from Cloud Storage.
+
+        Args:
+            bucket (str): Bucket name.
+            file_key (str): File path.
+
+        Returns:
+            chunks (iterator): Iterator of bytes chunks, read as they arrive.
+        """
+        bucket = self.client.get_bucket(bucket)
+        blob = bucket.blob(file_key)
+
+        with blob.open("rb", chunk_size=STREAM_CHUNK_SIZE) as reader:
+            yield from iter(lambda: reader.read(STREAM_CHUNK_SIZE), b"")
+
     def get_conversions(self, bucket: str, file_key: str):
         """
         Read a file with conversion data from Cloud Storage.
 
+        The file may be plain, gzip or zstd compressed CSV. It is decompressed
+        and parsed chunk by chunk while it is downloaded.
+
         Args:
             bucket (str): Bucket name.
             file_key (str): File key.
@@ -41,11 +156,7 @@ class LiftCloudStorageHandler:
         Returns:
             conversions (pandas.DataFrame): DataFrame containing the conversion data.
         """
-        data = self.read_file(bucket, file_key)
-        conversions = pd.read_csv(StringIO(data))
-        conversions["event_time"] = pd.to_datetime(conversions["event_time"])
-
-        return conversions
+        return read_conversions_csv(self.stream_file(bucket, file_key))
 
 
 class LiftDatabaseHandler:
@@ -53,8 +164,14 @@ class LiftDatabaseHandler:
     Class for handling lift study data.
     """
 
-    def __init__(self):
-        self.conn = None
+    def __init__(self, conn=None):
+        """
+        Args:
+            conn (mysql.connector.connection.MySQLConnection): Open connection to use,
+                such as a pooled connection of a LiftConnectionPool session. Defaults
+                to None (open one with connect).
+        """
+        self.conn = conn
 
     def __del__(self):
         """
@@ -209,3 +326,82 @@ class LiftDatabaseHandler:
         exists, _ = self.execute_query(query)
 
         return bool(int(exists[0][0]))
+
+
+class LiftConnectionPool:
+    """
+    Bounded pool of database connections, shared by the concurrent requests of an
+    instance. Each request gets its own LiftDatabaseHandler through session.
+    """
+
+    def __init__(
+        self,
+        db_host: str,
+        db_name: str,
+        db_user: str,
+        db_secret_name: str,
+        pool_size: int = 8,
+    ):
+        """
+        Args:
+            db_host (str): Host name or IP address of the MySQL db server.
+            db_name (str): Name of the database.
+            db_user (str): Username to connect to the database.
+            db_secret_name (str): name of the secret containing the database password.
+            pool_size (int): Maximum number of open connections. Defaults to 8.
+        """
+        self.config = {"host": db_host, "database": db_name, "user": db_user}
+        self.db_secret_name = db_secret_name
+        self.pool_size = pool_size
+        self.pool = None
+        self.lock = threading.Lock()
+        # MySQLConnectionPool fails right away when exhausted, requests wait here instead
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def get_pool(self) -> pooling.MySQLConnectionPool:
+        """
+        Get the connection pool, created by the first request of the instance.
+
+        Returns:
+            pool (mysql.connector.pooling.MySQLConnectionPool): Connection pool.
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = pooling.MySQLConnectionPool(
+                    pool_name="lift_studies",
+                    pool_size=self.pool_size,
+                    password=LiftDatabaseHandler.get_database_password(
+                        self.db_secret_name
+                    ),
+                    **self.config,
+                )
+
+        return self.pool
+
+    @contextmanager
+    def session(self, timeout: float = POOL_TIMEOUT_SECONDS):
+        """
+        Open a database session for a request.
+
+        The connection is returned to the pool when the session ends, and any
+        uncommitted changes are discarded when it is reset.
+
+        Args:
+            timeout (float): Seconds to wait for a connection when all of them are in
+                use. Defaults to POOL_TIMEOUT_SECONDS.
+
+        Yields:
+            db (LiftDatabaseHandler): Handler bound to a pooled connection.
+        """
+        assert self.slots.acquire(timeout=timeout), (
+            "Timed out waiting for a database connection."
+        )
+        try:
+            db = LiftDatabaseHandler(self.get_pool().get_connection())
+            try:
+                yield db
+            finally:
+                db.close()
+                db.conn = None
+        finally:
+            self.slots.release()
@@ -379,14 +379,18 @@ resource "google_cloudfunctions2_function" "default-lift-studies" {
   service_config {
     max_instance_count = 3
     min_instance_count = 1
-    available_memory   = "256M"
-    timeout_seconds    = 60
+    # concurrent requests share the instance, and its pool of DB_POOL_SIZE connections
+    max_instance_request_concurrency = 8
+    available_cpu                    = "1"
+    available_memory                 = "1Gi"
+    timeout_seconds                  = 60
     environment_variables = {
       DB_HOST        = google_sql_database_instance.wmg-db.private_ip_address
       DB_USER        = local.db_user
       DB_NAME        = local.db_name
       DB_SECRET_NAME = local.db_secret_name
       BUCKET_NAME    = google_storage_bucket.bucket.name
+      DB_POOL_SIZE   = 8
     }
     vpc_connector                  = google_vpc_access_connector.connector-wmg.name
     ingress_settings               = "ALLOW_ALL"